@@ -1,23 +1,51 @@
 from flask import Flask
 from flask_babel import Babel
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
-from config import basedir
+from jinja2 import FileSystemBytecodeCache
+from .assets import init_assets
+from .compression import init_compression
+from .database import RoutingSQLAlchemy, configure_engine
+from .profiling import init_profiling
 
-app = Flask(__name__)
-app.config.from_object('config')
-db = SQLAlchemy(app)
-babel = Babel(app)
+# Extensions are bound to each application in create_app, so importing the package builds nothing
+db = RoutingSQLAlchemy()
+babel = Babel()
 lm = LoginManager()
-lm.init_app(app)
-lm.login_view = 'login'
+lm.login_view = 'web.login'
 
 
-@app.template_filter('datetimeformat')
 def datetime_format(value, format='%m-%d-%Y'):
     return value.strftime(format)
 
-app.jinja_env.filters['datetimeformat'] = datetime_format
 
-from app import views, models
+def create_app(config='config', **overrides):
+    """Build an application from `config`, an import name or object, with individual keys from `overrides`."""
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(overrides)
+    if not app.config.get('SECRET_KEY'):
+        raise RuntimeError('SECRET_KEY is not configured; set the SECRET_KEY environment variable')
+    if app.config['SHARDS'] and app.config['IDENTITY_CACHE_BACKEND'] == 'memory':
+        # Page loads route by the shard in cached identity snapshots, so a move has to reach every process
+        raise RuntimeError("SHARDS needs a shared IDENTITY_CACHE_BACKEND, such as 'filesystem'")
 
+    configure_engine(app)
+    db.init_app(app)
+    babel.init_app(app)
+    lm.init_app(app)
+
+    app.jinja_env.filters['datetimeformat'] = datetime_format
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        # Compiled templates are reused by every worker and restart instead of being recompiled on first render
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_BYTECODE_CACHE_DIR'])
+    init_profiling(app)
+    init_assets(app)
+    init_compression(app)
+
+    # Importing these registers the models and the session hooks that maintain derived data
+    from . import models, projects, changes, push, search, archive, recurrence, agenda, jobs, identity, \
+        sharding
+    from .views import web, api
+    app.register_blueprint(web)
+    app.register_blueprint(api)
+    return app
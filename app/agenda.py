@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import func
+from app import db
+from .cache import TTLCache
+from .models import Task, TaskChange
+
+CALENDAR_HEADER = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Viortio//Tasks//EN', 'CALSCALE:GREGORIAN',
+                   'X-WR-CALNAME:Viortio tasks']
+CALENDAR_FOOTER = ['END:VCALENDAR', '']
+
+
+def get_feed_cache():
+    # user id -> (newest change log id applied, {task id: VEVENT text})
+    cache = current_app.extensions.get('calendar_feeds')
+    if cache is None:
+        config = current_app.config
+        cache = TTLCache(maxsize=config['CALENDAR_CACHE_SIZE'], ttl=config['CALENDAR_CACHE_TTL'])
+        current_app.extensions['calendar_feeds'] = cache
+    return cache
+
+
+def agenda_window(view, now):
+    """Return the [start, end) due date range of a named agenda view; None leaves that side open."""
+    today = datetime(now.year, now.month, now.day)
+    if view == 'overdue':
+        return None, now
+    if view == 'today':
+        return today, today + timedelta(days=1)
+    if view == 'week':
+        return today, today + timedelta(days=7)
+    raise ValueError('Unknown agenda view {}'.format(view))
+
+
+def agenda_key(user, view):
+    # What a view depends on besides the user's tasks: overdue changes whenever a due date passes,
+    # the other views when the day does
+    now = datetime.utcnow()
+    if view == 'overdue':
+        return user.next_due_date()
+    return agenda_window(view, now)[0].date()
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold(line):
+    # Content lines are limited to 75 octets; continuation lines start with a space
+    parts = []
+    limit = 75
+    while len(line.encode('utf-8')) > limit:
+        cut = limit
+        while len(line[:cut].encode('utf-8')) > limit:
+            cut -= 1
+        parts.append(line[:cut])
+        line = line[cut:]
+        limit = 74
+    parts.append(line)
+    return '\r\n '.join(parts)
+
+
+def render_event(task, now):
+    due = task.due_date
+    lines = ['BEGIN:VEVENT',
+             'UID:task-{}@viortio'.format(task.id),
+             'DTSTAMP:{:%Y%m%dT%H%M%SZ}'.format(now)]
+    if (due.hour, due.minute, due.second) == (0, 0, 0):
+        lines += ['DTSTART;VALUE=DATE:{:%Y%m%d}'.format(due),
+                  'DTEND;VALUE=DATE:{:%Y%m%d}'.format(due + timedelta(days=1))]
+    else:
+        lines += ['DTSTART:{:%Y%m%dT%H%M%SZ}'.format(due), 'DURATION:PT0S']
+    lines.append('SUMMARY:' + escape(task.name or ''))
+    if task.project:
+        lines.append('CATEGORIES:' + escape(task.project))
+    lines.append('END:VEVENT')
+    return '\r\n'.join(fold(line) for line in lines)
+
+
+def feed_query(user_id):
+    return Task.query.filter_by(user_id=user_id, complete=False).filter(Task.due_date != None)
+
+
+def calendar_events(user_id):
+    """Return the user's VEVENTs by task id, re-rendering only tasks changed since the cached copy."""
+    latest = db.session.query(func.max(TaskChange.id)).filter_by(user_id=user_id).scalar() or 0
+    feed_cache = get_feed_cache()
+    cached = feed_cache.get(user_id)
+    if cached is not None and cached[0] == latest:
+        return cached[1]
+
+    now = datetime.utcnow()
+    changed = None
+    if cached is not None:
+        limit = current_app.config['CALENDAR_MAX_CHANGES']
+        changed = db.session.query(TaskChange.task_id).filter(TaskChange.user_id == user_id, TaskChange.id > cached[0]) \
+            .distinct().limit(limit + 1).all()
+        changed = [task_id for task_id, in changed] if len(changed) <= limit else None
+
+    if changed is None:
+        events = {t.id: render_event(t, now) for t in feed_query(user_id)}
+    else:
+        events = dict(cached[1])
+        for task_id in changed:
+            events.pop(task_id, None)
+        for t in feed_query(user_id).filter(Task.id.in_(changed)):
+            events[t.id] = render_event(t, now)
+    feed_cache.set(user_id, (latest, events))
+    return events
+
+
+def calendar_feed(user_id):
+    events = calendar_events(user_id)
+    return '\r\n'.join(CALENDAR_HEADER + [events[task_id] for task_id in sorted(events)] + CALENDAR_FOOTER)
@@ -0,0 +1,84 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import event, select, insert, delete, func, literal
+from app import db
+from .changes import touch_users
+from .models import Task, ArchivedTask
+
+ARCHIVED_COLUMNS = ('id', 'name', 'start_date', 'due_date', 'project', 'user_id', 'complete', 'completed_at',
+                    'recurrence')
+
+
+@event.listens_for(Task.complete, 'set')
+def stamp_completion(task, value, oldvalue, initiator):
+    if not value:
+        task.completed_at = None
+    elif oldvalue is not True:
+        task.completed_at = datetime.utcnow()
+
+
+def archivable_query(cutoff, user_id=None, after=0):
+    # Ids of the tasks to archive past `after`, in id order. Batches seek on the primary key from the
+    # last id of the previous batch, so the open tasks before it are not read again.
+    completed_at = func.coalesce(Task.completed_at, Task.start_date)
+    # Recurring tasks waiting to create their next occurrence stay
+    query = select(Task.id).where(Task.id > after, Task.complete == True, completed_at < cutoff,
+                                  Task.next_occurrence == None)
+    if user_id is not None:
+        query = query.where(Task.user_id == user_id)
+    return query.order_by(Task.id)
+
+
+def move_to_archive(ids):
+    session = db.session
+    now = datetime.utcnow()
+    columns = [getattr(Task, c) for c in ARCHIVED_COLUMNS]
+    session.execute(insert(ArchivedTask.__table__).from_select(
+        ARCHIVED_COLUMNS + ('archived_at',), select(*columns, literal(now)).where(Task.id.in_(ids))))
+
+    # The change log and the project summaries are left alone: the tasks still exist for clients and
+    # still count as completed, they are only stored elsewhere. Core statements skip the flush hooks,
+    # so the versions are bumped here.
+    users = session.execute(select(Task.user_id).where(Task.id.in_(ids)).distinct()).scalars().all()
+    session.execute(delete(Task.__table__).where(Task.id.in_(ids)))
+    touch_users(session, set(users))
+
+
+def archive_tasks(days=None, user_id=None):
+    """Move tasks completed more than `days` days ago from the task table to the archive.
+
+    Tasks are moved in batches of ARCHIVE_BATCH_SIZE, each in its own transaction, and the
+    number moved is returned.
+    """
+    days = current_app.config['ARCHIVE_AFTER_DAYS'] if days is None else days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = 0
+    last_id = 0
+    while True:
+        query = archivable_query(cutoff, user_id, last_id).limit(current_app.config['ARCHIVE_BATCH_SIZE'])
+        ids = db.session.execute(query).scalars().all()
+        if not ids:
+            return moved
+        move_to_archive(ids)
+        db.session.commit()
+        moved += len(ids)
+        last_id = ids[-1]
+
+
+def restore_tasks(user_id, ids=None):
+    """Move the user's archived tasks, or those among `ids`, back into the task table.
+
+    Restored tasks go through the session so the usual flush hooks record them. They count
+    as completed now, so they stay out of the archive for another ARCHIVE_AFTER_DAYS.
+    Project summaries already count archived tasks and are left as they are.
+    """
+    query = ArchivedTask.query.filter_by(user_id=user_id)
+    if ids is not None:
+        query = query.filter(ArchivedTask.id.in_(ids))
+    archived = query.all()
+    for a in archived:
+        db.session.add(Task(id=a.id, name=a.name, start_date=a.start_date, due_date=a.due_date, project=a.project,
+                            user_id=a.user_id, complete=True))
+        db.session.delete(a)
+    db.session.commit()
+    return len(archived)
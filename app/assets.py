@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+from flask import current_app, send_from_directory, url_for, abort
+from werkzeug.utils import safe_join
+from .compression import brotli, negotiate
+
+MANIFEST = 'manifest.json'
+# Only text gets precompressed; images and fonts are compressed formats already
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+VARIANTS = (('br', '.br'), ('gzip', '.gz'))
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([^'")]*)\1\s*\)''')
+
+
+def fingerprint(path, content):
+    root, ext = posixpath.splitext(path)
+    return '{}.{}{}'.format(root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def rewrite_urls(path, content, manifest):
+    # Relative url() references in a stylesheet are pointed at the fingerprinted copies of the files they name
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, target, suffix = match.groups()
+        if '://' in target or target.startswith(('/', 'data:')):
+            return match.group(0)
+        hashed = manifest.get(posixpath.normpath(posixpath.join(directory, target)))
+        if hashed is None:
+            return match.group(0)
+        return 'url({0}{1}{2}{0})'.format(quote, posixpath.relpath(hashed, directory), suffix)
+
+    return CSS_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def write(path, data):
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+def build_assets(source, destination):
+    """Copy every file under `source` into `destination` under a name carrying a hash of its content.
+
+    Text files also get .gz and, when the brotli module is installed, .br variants. The manifest mapping
+    original names to fingerprinted ones is written last, and files from earlier builds are kept, so pages
+    rendered before a rebuild keep working. Returns the manifest.
+    """
+    paths = []
+    for root, dirs, files in os.walk(source):
+        paths += [os.path.relpath(os.path.join(root, name), source).replace(os.sep, '/') for name in files]
+    # Stylesheets go last so the files they reference already have their fingerprinted names
+    paths.sort(key=lambda p: (p.endswith('.css'), p))
+
+    manifest = {}
+    for path in paths:
+        with open(os.path.join(source, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = rewrite_urls(path, content, manifest)
+        hashed = manifest[path] = fingerprint(path, content)
+        target = os.path.join(destination, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        write(target, content)
+        if not path.endswith(COMPRESSIBLE):
+            continue
+        variants = {'.gz': gzip.compress(content, 9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(content, quality=11)
+        for suffix, data in variants.items():
+            if len(data) < len(content):
+                write(target + suffix, data)
+
+    write(os.path.join(destination, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def get_manifest():
+    # Read once per app; restart the app after rebuilding the assets
+    manifest = current_app.extensions.get('assets')
+    if manifest is None:
+        try:
+            with open(os.path.join(current_app.config['ASSETS_DIR'], MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        current_app.extensions['assets'] = manifest
+    return manifest
+
+
+def asset_url(filename):
+    """URL of the fingerprinted copy of a static file, or of the file itself when the assets are not built."""
+    hashed = get_manifest().get(filename)
+    if hashed is None:
+        return url_for('static', filename=filename)
+    return url_for('assets', filename=hashed)
+
+
+def serve_asset(filename):
+    directory = current_app.config['ASSETS_DIR']
+    path = safe_join(directory, filename)
+    if path is None or filename == MANIFEST or not os.path.isfile(path):
+        abort(404)
+
+    available = {encoding: suffix for encoding, suffix in VARIANTS if os.path.isfile(path + suffix)}
+    encoding = negotiate(tuple(available)) if available else None
+    response = send_from_directory(directory, filename + available[encoding] if encoding else filename,
+                                   mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                   max_age=current_app.config['ASSETS_MAX_AGE'])
+    # A fingerprinted name always has the same content, so browsers never need to revalidate it
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_assets(app):
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.add_url_rule('/assets/<path:filename>', 'assets', serve_asset)
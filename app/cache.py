@@ -0,0 +1,172 @@
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Bounded in-process LRU mapping whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] <= self.timer():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        expires = self.timer() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict(self, predicate):
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileSystemCache(object):
+    """Text cache kept as one file per key in `directory`, shared by processes on the same host.
+
+    Each file starts with its expiry time. Reads refresh the modification time, so when more
+    than `maxsize` files exist the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, maxsize=1024, ttl=300, timer=time.time):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key, default=None):
+        path = self.path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                expires = float(f.readline())
+                value = f.read()
+        except (OSError, ValueError):
+            self.misses += 1
+            return default
+        if expires <= self.timer():
+            self.delete(key)
+            self.misses += 1
+            return default
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = self.timer() + (self.ttl if ttl is None else ttl)
+        # Write to a temporary file and rename it so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('{!r}\n'.format(expires))
+            f.write(value)
+        os.replace(tmp, self.path(key))
+        self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        return [e for e in os.scandir(self.directory) if e.is_file() and not e.name.endswith('.tmp')]
+
+    def prune(self):
+        entries = self.entries()
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.maxsize]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in self.entries():
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'size': len(self), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self.entries())
+
+
+class CredentialCache(TTLCache):
+    """Remembers recently verified username/password pairs.
+
+    Credentials are stored as an HMAC digest keyed on the application secret, never as
+    plaintext. Each entry keeps the password hash it was verified against so that a
+    changed password invalidates it even if the change happened in another process.
+    """
+
+    def __init__(self, key, maxsize=1024, ttl=300, timer=time.monotonic):
+        super(CredentialCache, self).__init__(maxsize=maxsize, ttl=ttl, timer=timer)
+        self.key = key.encode('utf-8') if isinstance(key, str) else key
+
+    def digest(self, username, password):
+        msg = u'{}\x00{}'.format(username, password).encode('utf-8')
+        return hmac.new(self.key, msg, hashlib.sha256).digest()
+
+    def lookup(self, username, password):
+        return self.get(self.digest(username, password))
+
+    def remember(self, username, password, user_id, password_hash):
+        self.set(self.digest(username, password), (user_id, password_hash))
+
+    def forget_user(self, user_id):
+        self.evict(lambda entry: entry[0] == user_id)
@@ -0,0 +1,83 @@
+from datetime import datetime
+from itertools import chain
+from sqlalchemy import event, inspect, select, update, insert, func
+from app import db
+from .models import Task, TaskChange, UserVersion
+
+
+def changed_users(session):
+    # Ids of every user whose tasks are inserted, modified or deleted by the current flush
+    users = set()
+    for task in chain(session.new, session.deleted):
+        if isinstance(task, Task):
+            users.add(task.user_id)
+    for task in session.dirty:
+        if isinstance(task, Task) and session.is_modified(task):
+            users.add(task.user_id)
+            users.update(inspect(task).attrs.user_id.history.deleted)
+    users.discard(None)
+    return users
+
+
+def logged_changes(session):
+    # One change log row per task touched by the current flush
+    now = datetime.utcnow()
+    rows = []
+
+    def log(user_id, task_id, operation):
+        if user_id is not None:
+            rows.append({'user_id': user_id, 'task_id': task_id, 'operation': operation, 'created_at': now})
+
+    for task in session.new:
+        if isinstance(task, Task):
+            log(task.user_id, task.id, 'create')
+    for task in session.deleted:
+        if isinstance(task, Task):
+            log(task.user_id, task.id, 'delete')
+    for task in session.dirty:
+        if isinstance(task, Task) and session.is_modified(task):
+            state = inspect(task).attrs
+            # A task handed to another user disappears for the old owner and appears for the new one
+            for old_user in state.user_id.history.deleted:
+                log(old_user, task.id, 'delete')
+                log(task.user_id, task.id, 'create')
+            if not state.user_id.history.deleted:
+                completed = task.complete and state.complete.history.has_changes()
+                log(task.user_id, task.id, 'complete' if completed else 'update')
+    return rows
+
+
+@event.listens_for(db.session, 'after_flush')
+def log_changes(session, flush_context):
+    rows = logged_changes(session)
+    if rows:
+        session.execute(insert(TaskChange.__table__), rows)
+
+
+def touch_users(session, users):
+    # Bumps the change version behind conditional requests and cached fragments, on the shard holding the
+    # users' tasks; app.identity drops the users' cached snapshots once the transaction commits
+    table = UserVersion.__table__
+    now = datetime.utcnow()
+    session.execute(update(table).where(table.c.user_id.in_(users))
+                    .values(data_version=table.c.data_version + 1, data_modified=now))
+    missing = set(users) - set(session.execute(select(table.c.user_id).where(table.c.user_id.in_(users))).scalars())
+    if missing:
+        session.execute(insert(table), [{'user_id': user_id, 'data_version': 1, 'data_modified': now}
+                                        for user_id in sorted(missing)])
+    session.info.setdefault('touched_users', set()).update(users)
+
+
+def version_query(user_id):
+    # The user's (data_version, data_modified); (0, None) until their tasks first change
+    table = UserVersion.__table__
+    where = table.c.user_id == user_id
+    return select(func.coalesce(select(table.c.data_version).where(where).scalar_subquery(), 0),
+                  select(table.c.data_modified).where(where).scalar_subquery())
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_versions(session, flush_context):
+    users = changed_users(session)
+    if users:
+        touch_users(session, users)
@@ -0,0 +1,51 @@
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Encodings this process can produce, preferred first when the client rates them equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(encodings=ENCODINGS):
+    """Return the encoding among `encodings` the client rates highest in Accept-Encoding, or None for identity."""
+    accepted = request.accept_encodings
+    best = max(encodings, key=accepted.quality, default=None)
+    return best if best is not None and accepted.quality(best) > 0 else None
+
+
+def compress(data, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, config['COMPRESS_LEVEL'])
+
+
+def init_compression(app):
+
+    @app.after_request
+    def compress_response(response):
+        config = app.config
+        if response.mimetype not in config['COMPRESS_MIMETYPES']:
+            return response
+        response.vary.add('Accept-Encoding')
+        # Streams are left alone so that they keep flushing as they are generated
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed or \
+                'Content-Encoding' in response.headers:
+            return response
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        encoding = negotiate()
+        if encoding is None:
+            return response
+
+        response.set_data(compress(data, encoding, config))
+        response.content_encoding = encoding
+        # The compressed bytes differ from the identity ones, so a strong validator no longer holds
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,71 @@
+import sqlite3
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.util import find_tables
+
+
+def engine_options(uri, config):
+    """Engine and pool settings for the database at `uri`, taken from the DATABASE_* config keys."""
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        # pysqlite defaults to opening a fresh connection per checkout, which would rerun the
+        # pragmas and throw away the page cache every time
+        return {'poolclass': QueuePool, 'pool_size': config['DATABASE_POOL_SIZE'],
+                'max_overflow': config['DATABASE_MAX_OVERFLOW'], 'connect_args': {'check_same_thread': False}}
+    return {'pool_size': config['DATABASE_POOL_SIZE'], 'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+            'pool_recycle': config['DATABASE_POOL_RECYCLE'], 'pool_pre_ping': True}
+
+
+def configure_engine(app):
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          engine_options(app.config['SQLALCHEMY_DATABASE_URI'], app.config))
+    if app.config['SHARDS']:
+        # Each shard is a bind, so Flask-SQLAlchemy creates and pools its engine like any other
+        app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **app.config['SHARDS'])
+
+
+def is_sharded(table):
+    return table.info.get('sharded', False)
+
+
+def routes_to_shard(mapper, clause):
+    # Statements naming no table, such as raw SQL on the search index, follow the selected shard as well
+    if mapper is not None:
+        return is_sharded(mapper.persist_selectable)
+    tables = find_tables(clause, check_columns=True, include_crud=True) if clause is not None else []
+    # Columns such as the * of an EXISTS belong to no table
+    tables = [t for t in tables if t is not None]
+    return not tables or any(is_sharded(t) for t in tables)
+
+
+class RoutingSession(SignallingSession):
+    """Sends statements on sharded tables to the shard app.sharding selected, in session.info['shard']."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        shard = self.info.get('shard')
+        if shard is not None and routes_to_shard(mapper, clause):
+            return get_state(self.app).db.get_engine(self.app, bind=shard)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # Connections are opened inside the application context of the app whose engine they belong to
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not has_app_context():
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in current_app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
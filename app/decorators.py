@@ -0,0 +1,69 @@
+from datetime import timezone
+from functools import wraps
+from flask import g, request, make_response
+from app import db
+from .changes import version_query
+from .recurrence import materialize_occurrences, occurrences_due
+
+
+def user_version(materializes=False):
+    # The user's change version and modification time, and whether recurring occurrences are due; the
+    # version is kept with the tasks, so this is one query on the user's shard
+    query = version_query(g.user.id)
+    if not materializes:
+        return tuple(db.session.execute(query).one()) + (False,)
+    return tuple(db.session.execute(query.add_columns(occurrences_due(g.user.id))).one())
+
+
+def conditional(key=None):
+    """Answer conditional GETs from the current user's change version without running the view.
+
+    `key` is an optional callable returning anything else the response depends on, such as the
+    next start date for lists that change as time passes; such responses carry no Last-Modified.
+    Over a @materialized view, due recurring occurrences are looked for in the same lookup and only
+    created when there are some, so a 304 costs a single query.
+    """
+    def decorator(f):
+        materializes = getattr(f, 'materializes', False)
+        view = f.__wrapped__ if materializes else f
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            version, modified, due = user_version(materializes)
+            if due:
+                materialize_occurrences(g.user.id)
+                version, modified, due = user_version()
+            etag = '{}-{}'.format(g.user.id, version)
+            if key is not None:
+                etag += '-{}'.format(key())
+                modified = None
+            elif modified is not None:
+                modified = modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+            if request.if_none_match:
+                # Weak comparison, as compressed responses carry the tag in its weak form
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = modified is not None and request.if_modified_since is not None and \
+                    modified <= request.if_modified_since
+
+            response = make_response('', 304) if not_modified else make_response(view(*args, **kwargs))
+            response.set_etag(etag)
+            response.last_modified = modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Authorization')
+            return response
+        return decorated
+    return decorator
+
+
+def materialized(f):
+    """Create any recurring task occurrences whose start has arrived before running the view."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        materialize_occurrences(g.user.id)
+        return f(*args, **kwargs)
+    # Tells an enclosing @conditional to take over, so the check is skipped on 304s
+    decorated.materializes = True
+    return decorated
@@ -2,6 +2,7 @@ import re
 from flask_wtf import FlaskForm
 from wtforms import StringField, DateField, PasswordField, BooleanField, validators, ValidationError, widgets, SelectMultipleField
 from .models import User
+from .recurrence import normalize_rule
 
 
 class LoginForm(FlaskForm):
@@ -15,6 +16,13 @@ class TaskForm(FlaskForm):
     due_date = DateField('Due date', [validators.Optional()])
     start_date = DateField('Start date', [validators.Optional()])
     project = StringField('Project', [validators.Optional()])
+    recurrence = StringField('Repeat', [validators.Optional()])
+
+    def validate_recurrence(form, field):
+        try:
+            normalize_rule(field.data)
+        except ValueError:
+            raise ValidationError('Enter daily, weekly, monthly, yearly or an RRULE such as FREQ=WEEKLY;BYDAY=MO,TH')
 
 
 class RegistrationForm(FlaskForm):
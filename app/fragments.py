@@ -0,0 +1,53 @@
+import importlib
+from flask import g, current_app
+from markupsafe import Markup
+from .cache import TTLCache, FileSystemCache
+from .identity import current_version
+
+
+def memory_backend(app):
+    return TTLCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'], ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+
+def filesystem_backend(app):
+    return FileSystemCache(app.config['FRAGMENT_CACHE_DIR'], maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                           ttl=app.config['FRAGMENT_CACHE_TTL'])
+
+
+BACKENDS = {'memory': memory_backend, 'filesystem': filesystem_backend}
+
+
+def get_fragment_cache():
+    # FRAGMENT_CACHE_BACKEND names a built-in backend or gives 'package.module:factory'; None disables caching
+    backend = current_app.config['FRAGMENT_CACHE_BACKEND']
+    if not backend:
+        return None
+    cache = current_app.extensions.get('fragment_cache')
+    if cache is None:
+        if backend in BACKENDS:
+            factory = BACKENDS[backend]
+        else:
+            module, _, name = backend.partition(':')
+            factory = getattr(importlib.import_module(module), name)
+        cache = current_app.extensions['fragment_cache'] = factory(current_app)
+    return cache
+
+
+def cached_fragment(name, render, *key):
+    """Return the current user's rendered `name` fragment, calling `render` only on a cache miss.
+
+    Entries are keyed on the user's change version, which app.changes bumps on every task
+    mutation, so a change is never served stale; superseded entries age out of the cache.
+    `key` holds anything else the fragment depends on, such as a page cursor.
+    """
+    cache = get_fragment_cache()
+    if cache is None:
+        return Markup(render())
+    version, modified = current_version()
+    modified = modified.isoformat() if modified else None
+    cache_key = repr((g.user.id, version, modified, name) + key)
+    html = cache.get(cache_key)
+    if html is None:
+        html = render()
+        cache.set(cache_key, html)
+    return Markup(html)
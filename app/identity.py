@@ -0,0 +1,159 @@
+import importlib
+import json
+import secrets
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app, g, has_request_context
+from sqlalchemy import event, select
+from app import db
+from .cache import TTLCache, FileSystemCache
+from .changes import version_query
+from .models import User, UserBase, ShardAssignment
+
+
+class UserSnapshot(namedtuple('UserSnapshot', 'id nickname data_version data_modified shard moving'), UserBase):
+    """Immutable copy of the user data a request needs, safe to share between requests and threads.
+
+    With SHARDS set it also holds the user's shard assignment, which app.sharding routes page loads by.
+    """
+    __slots__ = ()
+
+    def to_json(self):
+        modified = self.data_modified.isoformat() if self.data_modified else None
+        return json.dumps([self.id, self.nickname, self.data_version, modified, self.shard, self.moving])
+
+    @classmethod
+    def from_json(cls, text):
+        id, nickname, version, modified, shard, moving = json.loads(text)
+        return cls(id, nickname, version, datetime.fromisoformat(modified) if modified else None, shard, moving)
+
+    def __repr__(self):
+        return '<UserSnapshot {}>'.format(self.nickname)
+
+
+INVALIDATED = 'invalidated'
+
+
+class IdentityCache(object):
+    """Maps user ids to snapshots, loading them from the database on a miss.
+
+    `store` is any cache with get, set and delete. Stores shared between processes, such as
+    FileSystemCache, hold text, so snapshots are kept in them as JSON.
+    """
+
+    def __init__(self, store, shared=False):
+        self.store = store
+        self.shared = shared
+
+    def decode(self, value):
+        # Invalidated entries hold a marker until they are loaded again, see load
+        if value is None or isinstance(value, str) and value.startswith(INVALIDATED):
+            return None
+        return UserSnapshot.from_json(value) if self.shared else value
+
+    def get(self, user_id):
+        return self.decode(self.store.get(str(user_id)))
+
+    def load(self, user_id):
+        entry = self.store.get(str(user_id))
+        snapshot = self.decode(entry)
+        if snapshot is None:
+            user = db.session.get(User, user_id)
+            if user is None:
+                return None
+            if current_app.config['SHARDS']:
+                row = db.session.execute(select(ShardAssignment.shard, ShardAssignment.moving)
+                                         .where(ShardAssignment.user_id == user_id)).first()
+                shard, moving = row or (None, False)
+                # The version is kept on the user's shard, which the session is not routed to yet
+                with (db.get_engine(bind=shard) if shard else db.engine).connect() as connection:
+                    version, modified = connection.execute(version_query(user_id)).one()
+            else:
+                shard, moving = None, False
+                version, modified = db.session.execute(version_query(user_id)).one()
+            snapshot = UserSnapshot(user.id, user.nickname, version, modified, shard, moving)
+            # Not kept while the user is being moved, so the end of the move is seen straight away, nor when
+            # an invalidation came in while it was read, as it may predate that change
+            if not snapshot.moving and self.store.get(str(user_id)) == entry:
+                self.store.set(str(user_id), snapshot.to_json() if self.shared else snapshot)
+        return snapshot
+
+    def invalidate(self, user_ids):
+        for user_id in user_ids:
+            self.store.set(str(user_id), '{} {}'.format(INVALIDATED, secrets.token_hex(8)))
+
+
+def memory_backend(app):
+    # Per-process: only suitable when a single process serves the app, as another process's
+    # changes cannot invalidate it
+    return IdentityCache(TTLCache(maxsize=app.config['IDENTITY_CACHE_SIZE'], ttl=app.config['IDENTITY_CACHE_TTL']))
+
+
+def filesystem_backend(app):
+    return IdentityCache(FileSystemCache(app.config['IDENTITY_CACHE_DIR'], maxsize=app.config['IDENTITY_CACHE_SIZE'],
+                                         ttl=app.config['IDENTITY_CACHE_TTL']), shared=True)
+
+
+BACKENDS = {'memory': memory_backend, 'filesystem': filesystem_backend}
+
+
+def get_identity_cache():
+    # IDENTITY_CACHE_BACKEND names a built-in backend or gives 'package.module:factory' returning an IdentityCache
+    cache = current_app.extensions.get('identity_cache')
+    if cache is None:
+        backend = current_app.config['IDENTITY_CACHE_BACKEND']
+        if backend in BACKENDS:
+            factory = BACKENDS[backend]
+        else:
+            module, _, name = backend.partition(':')
+            factory = getattr(importlib.import_module(module), name)
+        cache = current_app.extensions['identity_cache'] = factory(current_app)
+    return cache
+
+
+def load_snapshot(user_id):
+    return get_identity_cache().load(user_id)
+
+
+def current_version():
+    """Return the logged-in user's (data_version, data_modified), looking it up at most once per request.
+
+    A shared identity cache is invalidated by every process, so its snapshot holds the current version
+    until the request changes the user's tasks itself. The per-process cache misses the changes of other
+    processes, so the version is read from the database then.
+    """
+    version = g.get('user_version')
+    if version is None:
+        if isinstance(g.user, UserSnapshot) and get_identity_cache().shared and not g.get('user_changed'):
+            version = g.user.data_version, g.user.data_modified
+        else:
+            version = tuple(db.session.execute(version_query(g.user.id)).one())
+        g.user_version = version
+    return version
+
+
+@event.listens_for(db.session, 'after_flush')
+def remember_users(session, flush_context):
+    # Version bumps are recorded by app.changes.touch_users; this covers edits to the User rows themselves
+    # and to their shard assignments
+    changed = list(session.dirty) + list(session.deleted)
+    users = {u.id for u in changed if isinstance(u, User) and u.id is not None}
+    users.update(a.user_id for a in changed + list(session.new) if isinstance(a, ShardAssignment))
+    if users:
+        session.info.setdefault('touched_users', set()).update(users)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_users(session):
+    users = session.info.pop('touched_users', None)
+    if users:
+        get_identity_cache().invalidate(users)
+        # The request's own snapshot is now out of date too
+        if has_request_context() and getattr(g.get('user'), 'id', None) in users:
+            g.user_version = None
+            g.user_changed = True
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_users(session, previous_transaction):
+    session.info.pop('touched_users', None)
@@ -0,0 +1,156 @@
+import json
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update
+from app import db
+from .archive import archive_tasks
+from .models import Job
+from .sharding import each_shard
+
+# Job name -> function called with the job's payload as keyword arguments
+JOBS = {}
+
+
+def job(name):
+    """Register the decorated function as the handler for jobs called `name`."""
+    def decorator(f):
+        JOBS[name] = f
+        return f
+    return decorator
+
+
+def enqueue(name, owner=None, delay=0, max_attempts=None, **payload):
+    """Add a job to the session; it is queued when the caller commits, together with its other changes.
+
+    `owner` is the id of the user allowed to see the job through the API.
+    """
+    if name not in JOBS:
+        raise KeyError('Unknown job {}'.format(name))
+    j = Job(name=name, payload=json.dumps(payload), user_id=owner,
+            run_at=datetime.utcnow() + timedelta(seconds=delay),
+            max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'])
+    db.session.add(j)
+    return j
+
+
+def claim(worker_id):
+    # The status check in the UPDATE makes the claim atomic: of several workers racing for one
+    # job only the first matches a row, the others go back for the next one
+    now = datetime.utcnow()
+    while True:
+        job_id = db.session.execute(select(Job.id).where(Job.status == 'queued', Job.run_at <= now)
+                                    .order_by(Job.run_at, Job.id).limit(1)).scalar()
+        if job_id is None:
+            db.session.commit()
+            return None
+        claimed = db.session.execute(update(Job.__table__).where(Job.id == job_id, Job.status == 'queued').values(
+            status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1))
+        db.session.commit()
+        if claimed.rowcount:
+            return db.session.get(Job, job_id)
+
+
+def run_job(j):
+    """Run a claimed job, then record its success, schedule a retry or mark it failed."""
+    job_id = j.id
+    try:
+        JOBS[j.name](**json.loads(j.payload))
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        current_app.logger.warning('Job %s (%s) failed:\n%s', job_id, j.name, error)
+        j = db.session.get(Job, job_id)
+        j.last_error = error
+        j.locked_by = j.locked_at = None
+        if j.attempts < j.max_attempts:
+            j.status = 'queued'
+            delay = current_app.config['JOB_RETRY_DELAY'] * 2 ** (j.attempts - 1)
+            j.run_at = datetime.utcnow() + timedelta(seconds=delay)
+        else:
+            j.status = 'failed'
+            j.finished_at = datetime.utcnow()
+        db.session.commit()
+        return False
+    j = db.session.get(Job, job_id)
+    j.status = 'done'
+    j.finished_at = datetime.utcnow()
+    j.locked_by = j.locked_at = None
+    db.session.commit()
+    return True
+
+
+def requeue_stale():
+    # Jobs left running longer than JOB_TIMEOUT belonged to a worker that died. The interrupted run
+    # counts as an attempt, so a job that keeps killing its worker eventually fails.
+    now = datetime.utcnow()
+    stale = (Job.status == 'running', Job.locked_at < now - timedelta(seconds=current_app.config['JOB_TIMEOUT']))
+    table = Job.__table__
+    db.session.execute(update(table).where(*stale, Job.attempts >= Job.max_attempts)
+                       .values(status='failed', locked_by=None, locked_at=None, finished_at=now))
+    result = db.session.execute(update(table).where(*stale).values(status='queued', locked_by=None, locked_at=None))
+    db.session.commit()
+    return result.rowcount
+
+
+def work(app, worker_id=None):
+    """Run `app`'s queued jobs in this thread until none is due; returns the number run."""
+    worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+    count = 0
+    with app.app_context():
+        try:
+            while True:
+                j = claim(worker_id)
+                if j is None:
+                    return count
+                run_job(j)
+                count += 1
+        finally:
+            db.session.remove()
+
+
+class Worker(object):
+    """Pool of threads that poll `app`'s job table and run due jobs until stopped."""
+
+    def __init__(self, app, threads=None, poll_interval=None):
+        self.app = app
+        self.threads = threads or app.config['JOB_THREADS']
+        self.poll_interval = poll_interval or app.config['JOB_POLL_INTERVAL']
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self._stop = threading.Event()
+        self._threads = []
+
+    def loop(self, index):
+        worker_id = '{}:{}'.format(self.name, index)
+        while not self._stop.is_set():
+            try:
+                if index == 0:
+                    with self.app.app_context():
+                        requeue_stale()
+                        db.session.remove()
+                ran = work(self.app, worker_id)
+            except Exception:
+                self.app.logger.exception('Worker %s failed to poll for jobs', worker_id)
+                ran = 0
+            if not ran:
+                self._stop.wait(self.poll_interval)
+
+    def start(self):
+        for i in range(self.threads):
+            t = threading.Thread(target=self.loop, args=(i,), name='job-worker-{}'.format(i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+
+
+@job('archive_tasks')
+def archive_job(days=None, user_id=None):
+    for _ in each_shard(user_id):
+        archive_tasks(days, user_id)
@@ -1,21 +1,20 @@
+import hmac
 import json
+import secrets
 from datetime import datetime
-from sqlalchemy import desc
+from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer, BadSignature
+from flask import current_app
+from sqlalchemy import desc, func, event
 from app import db
 
 
-class DatetimeEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.strftime('%Y-%m-%d %H:%M:%S')
-        return json.JSONEncoder.default(self, o)
+# Marks the tables holding per-user task data, which app.database routes to the user's shard when SHARDS is set
+SHARDED = {'info': {'sharded': True}}
 
 
-class User(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    nickname = db.Column(db.String(80), index=True, unique=True)
-    password_hash = db.Column(db.String(256))
-    tasks = db.relationship('Task', backref='author', lazy='dynamic')
+class UserBase(object):
+    """Login properties and task queries shared by User rows and the cached snapshots of app.identity."""
+    __slots__ = ()
 
     @property
     def is_authenticated(self):
@@ -32,20 +31,134 @@ class User(db.Model):
     def get_id(self):
         return str(self.id)
 
+    @staticmethod
+    def token_serializer():
+        return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='api-token')
+
+    def generate_auth_token(self):
+        return User.token_serializer().dumps({'id': self.id, 'nickname': self.nickname})
+
+    @staticmethod
+    def calendar_serializer():
+        return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='calendar-feed')
+
+    def tasklist_query(self):
+        return Task.query.filter_by(user_id=self.id, complete=False).filter(Task.start_date <= datetime.utcnow())
+
+    def completed_tasks_query(self):
+        return Task.query.filter_by(user_id=self.id, complete=True)
+
+    def project_tasks_query(self, project):
+        return Task.query.filter_by(user_id=self.id, project=project, complete=False)
+
+    def agenda_query(self, start=None, end=None):
+        # Open tasks due in [start, end); a range scan on ix_task_user_complete_due
+        query = Task.query.filter_by(user_id=self.id, complete=False).filter(Task.due_date != None)
+        if start is not None:
+            query = query.filter(Task.due_date >= start)
+        if end is not None:
+            query = query.filter(Task.due_date < end)
+        return query
+
     def get_tasklist(self):
-        return Task.query.filter_by(user_id=self.id, complete=False).filter(Task.start_date <= datetime.utcnow()).order_by('start_date').all()
+        return self.tasklist_query().order_by(Task.start_date, Task.id).all()
+
+    def get_completed_tasks(self, limit=None):
+        return self.completed_tasks_query().order_by(desc(Task.start_date), desc(Task.id)).limit(limit).all()
+
+    def archived_tasks_query(self):
+        return ArchivedTask.query.filter_by(user_id=self.id)
+
+    def get_project_tasks(self, project):
+        return self.project_tasks_query(project).order_by(Task.start_date, Task.id).all()
+
+    def next_start_date(self):
+        # The next moment at which a pending task becomes visible in the task list
+        return db.session.query(func.min(Task.start_date)).filter(
+            Task.user_id == self.id, Task.complete == False, Task.start_date > datetime.utcnow()).scalar()
 
-    def get_completed_tasks(self):
-        return Task.query.filter_by(user_id=self.id, complete=True).order_by(desc('start_date')).all()
+    def next_due_date(self):
+        # The next moment at which an open task becomes overdue
+        return db.session.query(func.min(Task.due_date)).filter(
+            Task.user_id == self.id, Task.complete == False, Task.due_date > datetime.utcnow()).scalar()
+
+    def projects_query(self):
+        return Project.query.with_entities(Project.name).filter_by(user_id=self.id).order_by(Project.name)
 
     def get_projects(self):
-        return Task.query.with_entities(Task.project.distinct()).filter_by(user_id=self.id).filter(Task.project != None).order_by('project').all()
+        return self.projects_query().all()
+
+    def get_project_summaries(self):
+        return Project.query.filter_by(user_id=self.id).order_by(Project.name).all()
 
 
+class User(UserBase, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    nickname = db.Column(db.String(80), index=True, unique=True)
+    password_hash = db.Column(db.String(256))
+    # Signed into calendar feed URLs; None until the first URL is issued
+    calendar_secret = db.Column(db.String(32))
+    tasks = db.relationship('Task', backref='author', lazy='dynamic')
+
+    @staticmethod
+    def verify_auth_token(token):
+        # Tokens are self-contained, so a valid one yields a detached User without touching the database
+        try:
+            data = User.token_serializer().loads(token, max_age=current_app.config['TOKEN_EXPIRATION'])
+        except BadSignature:
+            return None
+        return User(id=data['id'], nickname=data['nickname'])
+
+    @staticmethod
+    def verify_calendar_token(token):
+        # Checked against the stored secret, so the URLs of deleted users and reset secrets stop working
+        try:
+            data = User.calendar_serializer().loads(token)
+        except BadSignature:
+            return None
+        user = db.session.get(User, data['id'])
+        if user is None or user.calendar_secret is None or \
+                not hmac.compare_digest(user.calendar_secret, str(data.get('secret'))):
+            return None
+        return user
+
+    def calendar_token(self):
+        # Calendar apps cannot send credentials, so the feed URL itself is the secret and does not expire.
+        # It signs a per-user secret, which a password change or reset_calendar_secret replaces.
+        if self.calendar_secret is None:
+            self.reset_calendar_secret()
+        return User.calendar_serializer().dumps({'id': self.id, 'secret': self.calendar_secret})
+
+    def reset_calendar_secret(self):
+        self.calendar_secret = secrets.token_urlsafe(16)
+
     def __repr__(self):
         return '<User {}>'.format(self.nickname)
 
+@event.listens_for(User.password_hash, 'set')
+def revoke_calendar_urls(target, value, oldvalue, initiator):
+    # A new password also revokes feed URLs that may have leaked with the old one
+    if value != oldvalue:
+        target.calendar_secret = None
+
+
 class Task(db.Model):
+    FIELDS = ('id', 'name', 'due_date', 'start_date', 'project', 'complete', 'recurrence')
+    # The v1 API payload is frozen; fields added since are only served in the v2 format
+    V1_FIELDS = ('id', 'name', 'due_date', 'start_date', 'project', 'complete')
+    DATETIME_FIELDS = ('due_date', 'start_date')
+    # Composite indexes for the per-user access paths: pending/completed lists ordered by start date,
+    # project listings, pending recurrences and agenda ranges by due date. SQLite appends the rowid
+    # (Task.id) to each, which covers the keyset tie-breaker.
+    __table_args__ = (
+        db.Index('ix_task_user_complete_start', 'user_id', 'complete', 'start_date'),
+        db.Index('ix_task_user_project', 'user_id', 'project', 'complete', 'start_date'),
+        db.Index('ix_task_user_next_occurrence', 'user_id', 'next_occurrence'),
+        db.Index('ix_task_user_complete_due', 'user_id', 'complete', 'due_date'),
+        # AUTOINCREMENT keeps SQLite from handing out the id of a deleted task, which may still be in the archive
+        dict(SHARDED, sqlite_autoincrement=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(140), index=True)
     start_date = db.Column(db.DateTime, index=True)
@@ -53,12 +166,155 @@ class Task(db.Model):
     project = db.Column(db.String(140), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     complete = db.Column(db.Boolean, default=False)
+    # Stamped by app.archive when the task is completed; older completed rows fall back to start_date
+    completed_at = db.Column(db.DateTime)
+    # Rule from app.recurrence; once a recurring task is completed, next_occurrence holds the start of its successor
+    recurrence = db.Column(db.String(255))
+    next_occurrence = db.Column(db.DateTime)
+
+    def to_dict(self, fields=FIELDS):
+        d = {f: getattr(self, f) for f in fields}
+        for f in self.DATETIME_FIELDS:
+            # isoformat produces the same '%Y-%m-%d %H:%M:%S' text as strftime for naive datetimes, several times faster
+            if d.get(f) is not None:
+                d[f] = d[f].isoformat(' ', 'seconds')
+        return d
 
-    def to_JSON(self):
-        d = {'id': self.id, 'name': self.name, 'due_date': self.due_date, 'start_date': self.start_date,
-             'project': self.project, 'complete': self.complete}
-        return json.dumps(d, sort_keys=True, cls=DatetimeEncoder)
+    def to_JSON(self, fields=V1_FIELDS):
+        return json.dumps(self.to_dict(fields), sort_keys=True)
 
     def __repr__(self):
         return 'Task is: {}'.format(self.name)
 
+
+class ArchivedTask(db.Model):
+    # Completed tasks moved out of the task table by app.archive. Rows keep their task id, so reads
+    # that merge both tables and clients holding the task keep seeing the same task.
+    FIELDS = Task.FIELDS
+    V1_FIELDS = Task.V1_FIELDS
+    DATETIME_FIELDS = Task.DATETIME_FIELDS
+    __table_args__ = (db.Index('ix_archived_task_user_start', 'user_id', 'start_date'), SHARDED)
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(140))
+    start_date = db.Column(db.DateTime)
+    due_date = db.Column(db.DateTime)
+    project = db.Column(db.String(140))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    complete = db.Column(db.Boolean, nullable=False, default=True)
+    completed_at = db.Column(db.DateTime)
+    recurrence = db.Column(db.String(255))
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    to_dict = Task.to_dict
+    to_JSON = Task.to_JSON
+
+    def __repr__(self):
+        return 'Archived task is: {}'.format(self.name)
+
+
+class Project(db.Model):
+    # Per-user summary of the tasks in each project, kept up to date by app.projects on every flush
+    __table_args__ = (db.UniqueConstraint('user_id', 'name'), SHARDED)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(140), nullable=False)
+    open_count = db.Column(db.Integer, nullable=False, default=0)
+    completed_count = db.Column(db.Integer, nullable=False, default=0)
+    next_due_date = db.Column(db.DateTime)
+
+    def to_dict(self):
+        next_due_date = self.next_due_date.isoformat(' ', 'seconds') if self.next_due_date else None
+        return {'name': self.name, 'open_count': self.open_count, 'completed_count': self.completed_count,
+                'next_due_date': next_due_date}
+
+    def __repr__(self):
+        return '<Project {}>'.format(self.name)
+
+
+class TaskChange(db.Model):
+    # Append-only log of task mutations written by app.changes; the id doubles as the sync cursor
+    __table_args__ = (db.Index('ix_task_change_user_id', 'user_id', 'id'), SHARDED)
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    task_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<TaskChange {} {}>'.format(self.operation, self.task_id)
+
+
+class UserVersion(db.Model):
+    # Bumped by app.changes whenever one of the user's tasks changes, for conditional requests and cached
+    # fragments. It lives with the tasks, on the user's shard, so task writes leave the main database alone.
+    __table_args__ = SHARDED
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+    data_modified = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<UserVersion {} {}>'.format(self.user_id, self.data_version)
+
+
+class Job(db.Model):
+    # Deferred work for the worker in app.jobs; queued jobs are picked up oldest run_at first
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(80))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        finished_at = self.finished_at.isoformat(' ', 'seconds') if self.finished_at else None
+        return {'id': self.id, 'name': self.name, 'status': self.status, 'attempts': self.attempts,
+                'finished_at': finished_at}
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(self.name, self.status)
+
+
+class ShardAssignment(db.Model):
+    # Which shard holds each user's tasks, maintained by app.sharding; users without a row, or with no
+    # shard, are still in the main database
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    shard = db.Column(db.String(64))
+    # Set while app.sharding moves the user's tasks, during which their requests are turned away
+    moving = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return '<ShardAssignment {} {}>'.format(self.user_id, self.shard)
+
+
+class IdSequence(db.Model):
+    # Next id to hand out for a table whose ids must be unique across shards; see app.sharding.reserve_ids
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<IdSequence {} {}>'.format(self.name, self.next_id)
+
+
+class IdBlock(db.Model):
+    # Ids [next_id, end_id) a shard claimed from IdSequence and hands out itself; see app.sharding.reserve_ids
+    __table_args__ = SHARDED
+
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+    end_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return '<IdBlock {} {}-{}>'.format(self.name, self.next_id, self.end_id)
@@ -0,0 +1,73 @@
+import base64
+from datetime import datetime
+from sqlalchemy import or_, and_
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(start_date, id):
+    # Tasks without a start date get an empty date; they sort before every dated task, as SQLite does by default
+    raw = '{}|{}'.format(start_date.strftime(CURSOR_DATE_FORMAT) if start_date is not None else '', id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the (start_date, id) pair encoded in `cursor`, raising ValueError if it is malformed."""
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    start_date, id = raw.split('|')
+    return datetime.strptime(start_date, CURSOR_DATE_FORMAT) if start_date else None, int(id)
+
+
+def sort_key(row):
+    """Python equivalent of the (start_date, id) order keyset_query gives, with missing start dates first."""
+    return row.start_date is not None, row.start_date or datetime.min, row.id
+
+
+def keyset_query(query, start_date, id, cursor=None, descending=False):
+    """Order `query` on (start_date, id) and restrict it to the rows after `cursor`.
+
+    `start_date` and `id` are the column expressions to order and seek on. Rows without a start date come
+    first, or last when descending.
+    """
+    if cursor:
+        after_date, after_id = decode_cursor(cursor)
+        if after_date is None:
+            same_date = and_(start_date.is_(None), id < after_id if descending else id > after_id)
+            query = query.filter(same_date if descending else or_(same_date, start_date.isnot(None)))
+        # The redundant bound on start_date alone lets the database seek on an index instead of filtering
+        elif descending:
+            query = query.filter(or_(and_(start_date <= after_date, or_(start_date < after_date, id < after_id)),
+                                     start_date.is_(None)))
+        else:
+            query = query.filter(start_date >= after_date, or_(start_date > after_date, id > after_id))
+
+    if descending:
+        return query.order_by(start_date.desc().nullslast(), id.desc())
+    return query.order_by(start_date.asc().nullsfirst(), id)
+
+
+def keyset_page(query, start_date, id, cursor=None, limit=50, descending=False):
+    """Fetch one page of `query` ordered on (start_date, id) strictly after `cursor`.
+
+    Returns the rows and the cursor of the next page, which is None once the last page has been reached.
+    """
+    return keyset_merge([(query, start_date, id)], cursor, limit, descending)
+
+
+def keyset_merge(queries, cursor=None, limit=50, descending=False):
+    """Fetch one page across several (query, start_date, id) sources whose ids do not overlap.
+
+    Each source is seeked separately and the rows are merged, so the page is the same as one
+    keyset_page over the union of the sources. A `limit` of None fetches every remaining row.
+    """
+    rows = []
+    for query, start_date, id in queries:
+        rows.extend(keyset_query(query, start_date, id, cursor, descending).limit(None if limit is None else limit + 1))
+    if len(queries) > 1:
+        rows.sort(key=sort_key, reverse=descending)
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].start_date, rows[-1].id)
+    return rows, next_cursor
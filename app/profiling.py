@@ -0,0 +1,151 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+@contextmanager
+def timed(name):
+    """Add the time spent in the block to the current request's profile under `name`."""
+    profile = g.get('profile') if has_request_context() else None
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile[name] = profile.get(name, 0.0) + time.perf_counter() - start
+
+
+def profiled(name, f):
+    """Wrap `f` so that calls to it are timed under `name`."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with timed(name):
+            return f(*args, **kwargs)
+    return wrapper
+
+
+class ProfiledTemplate(Template):
+    # Only top-level renders go through render(); included templates are part of their parent's time
+    def render(self, *args, **kwargs):
+        with timed('render'):
+            return super(ProfiledTemplate, self).render(*args, **kwargs)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def to_dict(self):
+        labels = ['le_{}'.format(b) for b in self.buckets] + ['inf']
+        return {'buckets': dict(zip(labels, self.counts)), 'sum': round(self.total, 3)}
+
+
+class EndpointMetrics(object):
+
+    def __init__(self, buckets):
+        self.requests = 0
+        self.flagged = 0
+        self.max_queries = 0
+        self.wall_ms = Histogram(buckets)
+        self.sql_ms = Histogram(buckets)
+        self.queries = Histogram([1, 2, 5, 10, 20, 50, 100])
+        self.timings = {}
+
+    def to_dict(self):
+        return {'requests': self.requests, 'flagged': self.flagged, 'max_queries': self.max_queries,
+                'wall_ms': self.wall_ms.to_dict(), 'sql_ms': self.sql_ms.to_dict(), 'queries': self.queries.to_dict(),
+                'timings_ms': {name: round(total, 3) for name, total in self.timings.items()}}
+
+
+class Metrics(object):
+    """Per-endpoint aggregates of request profiles, kept in this process."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, wall, profile, flagged):
+        with self._lock:
+            m = self.endpoints.get(endpoint)
+            if m is None:
+                m = self.endpoints[endpoint] = EndpointMetrics(self.buckets)
+            m.requests += 1
+            m.flagged += flagged
+            m.max_queries = max(m.max_queries, profile['queries'])
+            m.wall_ms.add(wall * 1000)
+            m.sql_ms.add(profile['sql'] * 1000)
+            m.queries.add(profile['queries'])
+            for name, elapsed in profile.items():
+                if name != 'queries':
+                    m.timings[name] = m.timings.get(name, 0.0) + elapsed * 1000
+
+    def to_dict(self):
+        with self._lock:
+            return {endpoint: m.to_dict() for endpoint, m in self.endpoints.items()}
+
+    def clear(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('profile') is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if starts and has_request_context() and g.get('profile') is not None:
+        g.profile['queries'] += 1
+        g.profile['sql'] += time.perf_counter() - starts.pop()
+
+
+def init_profiling(app):
+    # Hooks are always installed but do nothing unless PROFILING is set when the request starts
+    metrics = app.extensions['profiling'] = Metrics(app.config['PROFILING_BUCKETS'])
+    app.jinja_env.template_class = ProfiledTemplate
+
+    @app.before_request
+    def start_profile():
+        if app.config['PROFILING']:
+            g.profile = {'queries': 0, 'sql': 0.0}
+            g.profile_start = time.perf_counter()
+
+    @app.after_request
+    def record_profile(response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        wall = time.perf_counter() - g.profile_start
+        endpoint = request.endpoint or 'unmatched'
+        flagged = profile['queries'] > app.config['PROFILING_QUERY_THRESHOLD']
+        if flagged:
+            app.logger.warning('%s %s issued %d SQL statements', request.method, request.path, profile['queries'])
+        metrics.record(endpoint, wall, profile, flagged)
+
+        timings = ['{};dur={:.2f}'.format(name, elapsed * 1000) for name, elapsed in sorted(profile.items())
+                   if name != 'queries']
+        timings.append('total;dur={:.2f}'.format(wall * 1000))
+        response.headers['Server-Timing'] = ', '.join(timings)
+        response.headers['X-Query-Count'] = str(profile['queries'])
+        return response
+
+    return metrics
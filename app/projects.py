@@ -0,0 +1,126 @@
+from collections import defaultdict
+from sqlalchemy import event, inspect, select, insert, update, delete, func, case, union_all
+from app import db
+from .models import Task, ArchivedTask, Project
+
+TRACKED = ('user_id', 'project', 'complete', 'due_date')
+
+
+def previous_state(task):
+    # The tracked attributes as they were before the current flush
+    state = inspect(task)
+    values = []
+    for attr in TRACKED:
+        history = state.attrs[attr].history
+        if history.deleted:
+            values.append(history.deleted[0])
+        elif history.unchanged:
+            values.append(history.unchanged[0])
+        else:
+            values.append(getattr(task, attr))
+    return values[0], values[1], bool(values[2]), values[3]
+
+
+def current_state(task):
+    return task.user_id, task.project, bool(task.complete), task.due_date
+
+
+class ProjectChanges(object):
+
+    def __init__(self):
+        self.open = 0
+        self.completed = 0
+        self.due_dates = []
+        self.recompute_due = False
+
+
+def collect_changes(session):
+    changes = defaultdict(ProjectChanges)
+
+    def leave(user_id, project, complete, due_date):
+        if project is None:
+            return
+        c = changes[(user_id, project)]
+        if complete:
+            c.completed -= 1
+        else:
+            c.open -= 1
+            # Only losing an open task with a due date can move the next due date later
+            c.recompute_due = c.recompute_due or due_date is not None
+
+    def enter(user_id, project, complete, due_date):
+        if project is None:
+            return
+        c = changes[(user_id, project)]
+        if complete:
+            c.completed += 1
+        else:
+            c.open += 1
+            if due_date is not None:
+                c.due_dates.append(due_date)
+
+    for task in session.new:
+        if isinstance(task, Task):
+            enter(*current_state(task))
+    for task in session.deleted:
+        if isinstance(task, Task):
+            leave(*previous_state(task))
+        elif isinstance(task, ArchivedTask):
+            # Archived tasks stay in their project's completed count until they are restored or deleted
+            leave(task.user_id, task.project, True, task.due_date)
+    for task in session.dirty:
+        if isinstance(task, Task):
+            before, after = previous_state(task), current_state(task)
+            if before != after:
+                leave(*before)
+                enter(*after)
+    return changes
+
+
+def apply_changes(session, user_id, name, changes):
+    table = Project.__table__
+    row = session.execute(select(table.c.id, table.c.next_due_date)
+                          .where(table.c.user_id == user_id, table.c.name == name)).first()
+
+    if changes.recompute_due:
+        next_due_date = select(func.min(Task.due_date)).where(
+            Task.user_id == user_id, Task.project == name, Task.complete == False).scalar_subquery()
+    else:
+        candidates = changes.due_dates + ([row.next_due_date] if row and row.next_due_date else [])
+        next_due_date = min(candidates) if candidates else None
+
+    if row is None:
+        if changes.open + changes.completed <= 0:
+            return
+        session.execute(insert(table).values(user_id=user_id, name=name, open_count=changes.open,
+                                             completed_count=changes.completed, next_due_date=next_due_date))
+        return
+
+    session.execute(update(table).where(table.c.id == row.id).values(
+        open_count=table.c.open_count + changes.open, completed_count=table.c.completed_count + changes.completed,
+        next_due_date=next_due_date))
+    session.execute(delete(table).where(table.c.id == row.id, table.c.open_count + table.c.completed_count <= 0))
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_projects(session, flush_context):
+    for (user_id, name), changes in collect_changes(session).items():
+        if changes.open or changes.completed or changes.due_dates or changes.recompute_due:
+            apply_changes(session, user_id, name, changes)
+
+
+def rebuild_projects():
+    # Recomputes every summary from the task and archive tables, for databases that predate the project table
+    table = Project.__table__
+    tasks = union_all(*(select(t.user_id, t.project, t.complete, t.due_date).where(t.project != None)
+                        for t in (Task, ArchivedTask))).subquery()
+    open_tasks = func.sum(case((tasks.c.complete == False, 1), else_=0))
+    completed_tasks = func.sum(case((tasks.c.complete == True, 1), else_=0))
+    next_due_date = func.min(case((tasks.c.complete == False, tasks.c.due_date)))
+    rows = select(tasks.c.user_id, tasks.c.project, open_tasks, completed_tasks, next_due_date) \
+        .group_by(tasks.c.user_id, tasks.c.project)
+
+    db.session.execute(delete(table))
+    db.session.execute(insert(table).from_select(
+        ['user_id', 'name', 'open_count', 'completed_count', 'next_due_date'], rows))
+    db.session.commit()
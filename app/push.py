@@ -0,0 +1,89 @@
+import importlib
+import threading
+import time
+from flask import current_app
+from sqlalchemy import event, select, func
+from app import db
+from .changes import changed_users
+from .models import TaskChange
+
+
+class MemoryBroker(object):
+    """Wakes streams waiting in this process; suitable for a single worker and for tests."""
+
+    def __init__(self, app):
+        self._latest = {}
+        self._condition = threading.Condition()
+
+    def publish(self, user_id, change_id):
+        with self._condition:
+            self._latest[user_id] = max(change_id, self._latest.get(user_id, 0))
+            self._condition.notify_all()
+
+    def wait(self, user_id, after, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: self._latest.get(user_id, 0) > after, timeout)
+
+
+class DatabaseBroker(object):
+    """Polls the shared change log, so workers in other processes see each other's changes."""
+
+    def __init__(self, app):
+        self.interval = app.config['PUSH_POLL_INTERVAL']
+
+    def publish(self, user_id, change_id):
+        pass
+
+    def wait(self, user_id, after, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            latest = db.session.query(func.max(TaskChange.id)).filter_by(user_id=user_id).scalar() or 0
+            # Hand the connection back to the pool between polls
+            db.session.close()
+            if latest > after:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+
+BACKENDS = {'memory': MemoryBroker, 'database': DatabaseBroker}
+
+
+def get_broker():
+    # PUSH_BACKEND names a built-in backend or gives 'package.module:Class' for another fan-out implementation
+    broker = current_app.extensions.get('push_broker')
+    if broker is None:
+        backend = current_app.config['PUSH_BACKEND']
+        if backend in BACKENDS:
+            cls = BACKENDS[backend]
+        else:
+            module, _, name = backend.partition(':')
+            cls = getattr(importlib.import_module(module), name)
+        broker = current_app.extensions['push_broker'] = cls(current_app)
+    return broker
+
+
+@event.listens_for(db.session, 'after_flush')
+def remember_changes(session, flush_context):
+    # The change log rows for this flush have been written by app.changes; note the newest id per user
+    users = changed_users(session)
+    if users:
+        rows = session.execute(select(TaskChange.user_id, func.max(TaskChange.id))
+                               .where(TaskChange.user_id.in_(users)).group_by(TaskChange.user_id))
+        session.info.setdefault('push_pending', {}).update(dict(rows.all()))
+
+
+@event.listens_for(db.session, 'after_commit')
+def publish_changes(session):
+    pending = session.info.pop('push_pending', None)
+    if pending:
+        broker = get_broker()
+        for user_id, change_id in pending.items():
+            broker.publish(user_id, change_id)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def discard_changes(session, previous_transaction):
+    session.info.pop('push_pending', None)
@@ -0,0 +1,74 @@
+from datetime import datetime
+from dateutil.rrule import rrulestr
+from sqlalchemy import event, exists
+from app import db
+from .models import Task
+
+NAMED_RULES = {'daily': 'FREQ=DAILY', 'weekly': 'FREQ=WEEKLY', 'monthly': 'FREQ=MONTHLY', 'yearly': 'FREQ=YEARLY'}
+
+
+def parse_rule(rule, start):
+    """Return the dateutil rrule for `rule`, a named rule or an RRULE string, starting at `start`."""
+    text = NAMED_RULES.get(rule.lower(), rule)
+    # Every occurrence restarts the rule from its own start date, so a COUNT would never run out
+    if 'COUNT=' in text.upper():
+        raise ValueError('COUNT is not supported in recurrence rules, use UNTIL')
+    return rrulestr(text, dtstart=start)
+
+
+def normalize_rule(rule):
+    """Validate a recurrence rule from a form or API payload, returning None for an empty one.
+
+    Raises ValueError if the rule cannot be parsed.
+    """
+    if not rule:
+        return None
+    if not isinstance(rule, str):
+        raise ValueError('Recurrence must be a string')
+    rule = rule.strip()
+    parse_rule(rule, datetime.utcnow())
+    return rule.lower() if rule.lower() in NAMED_RULES else rule
+
+
+def next_start(task, now):
+    # The first occurrence after the task's own start that is still in the future; None once an UNTIL has passed
+    return parse_rule(task.recurrence, task.start_date).after(max(task.start_date, now))
+
+
+@event.listens_for(db.session, 'before_flush')
+def schedule_occurrences(session, flush_context, instances):
+    # Completing a recurring task only records when its successor starts; the successor row is
+    # created by materialize_occurrences once that moment has arrived
+    now = datetime.utcnow()
+    for task in list(session.new) + list(session.dirty):
+        if not isinstance(task, Task) or not task.recurrence:
+            continue
+        if task.complete and task.next_occurrence is None and task.start_date is not None:
+            task.next_occurrence = next_start(task, now)
+        elif not task.complete and task.next_occurrence is not None:
+            task.next_occurrence = None
+
+
+def occurrences_due(user_id, now=None):
+    """Return an EXISTS clause that is true while materialize_occurrences has work to do for the user."""
+    return exists().where(Task.user_id == user_id, Task.next_occurrence <= (now or datetime.utcnow()))
+
+
+def materialize_occurrences(user_id, now=None):
+    """Create the next occurrence of each of the user's completed recurring tasks whose start has arrived.
+
+    The recurrence rule moves to the new occurrence, so each series has a single open task.
+    Returns the number of tasks created.
+    """
+    now = now or datetime.utcnow()
+    due = Task.query.filter(Task.user_id == user_id, Task.next_occurrence <= now).all()
+    for task in due:
+        shift = task.next_occurrence - task.start_date
+        db.session.add(Task(name=task.name, user_id=task.user_id, project=task.project, recurrence=task.recurrence,
+                            start_date=task.next_occurrence,
+                            due_date=task.due_date + shift if task.due_date else None))
+        task.recurrence = None
+        task.next_occurrence = None
+    if due:
+        db.session.commit()
+    return len(due)
@@ -0,0 +1,71 @@
+from sqlalchemy import inspect, select, insert, table, column
+from app import db
+from .models import Task, UserVersion, ShardAssignment
+from .projects import rebuild_projects
+from .search import create_search_index
+
+
+def upgrade_schema():
+    # sqlalchemy-migrate only diffs tables and columns, so once its scripts have run this creates
+    # any tables and indexes declared on the models that the database is still missing
+    existing = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    autoincrement_task_ids()
+    move_user_versions()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+    # Derived tables start out empty and are filled from the tasks they summarize
+    if 'project' not in existing:
+        rebuild_projects()
+    create_search_index()
+
+
+def autoincrement_task_ids(engine=None):
+    """Rebuild a task table created before it was declared AUTOINCREMENT, which SQLite cannot add in place.
+
+    The sequence starts past every archived id as well, so no new task takes the id of one in the archive.
+    """
+    with (engine or db.engine).begin() as connection:
+        if connection.dialect.name != 'sqlite':
+            return
+        sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'task'") \
+            .scalar()
+        if sql is None or 'AUTOINCREMENT' in sql.upper():
+            return
+
+        connection.exec_driver_sql('ALTER TABLE task RENAME TO task_old')
+        # Indexes and triggers move with the renamed table under their old names, so they are dropped first
+        for kind, name in connection.exec_driver_sql("SELECT type, name FROM sqlite_master WHERE tbl_name = 'task_old' "
+                                                     "AND type IN ('index', 'trigger') AND sql IS NOT NULL").all():
+            connection.exec_driver_sql('DROP {} {}'.format(kind.upper(), name))
+        # The search index triggers created with the new table fill task_fts again as the rows are copied
+        if inspect(connection).has_table('task_fts'):
+            connection.exec_driver_sql('DELETE FROM task_fts')
+        Task.__table__.create(connection)
+        columns = ', '.join(c['name'] for c in inspect(connection).get_columns('task_old'))
+        connection.exec_driver_sql('INSERT INTO task ({0}) SELECT {0} FROM task_old'.format(columns))
+        connection.exec_driver_sql('DROP TABLE task_old')
+
+        connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'task'")
+        connection.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) SELECT 'task', "
+                                   "MAX((SELECT COALESCE(MAX(id), 0) FROM task), "
+                                   "(SELECT COALESCE(MAX(id), 0) FROM archived_task))")
+
+
+def move_user_versions():
+    """Start the user_version rows of users in the main database from the version columns of the user table.
+
+    Versions used to be kept on the user row; carrying them over keeps clients' ETags from matching again.
+    """
+    if 'data_version' not in {c['name'] for c in inspect(db.engine).get_columns('user')}:
+        return
+    user = table('user', column('id'), column('data_version'), column('data_modified'))
+    versions = UserVersion.__table__
+    moved = select(ShardAssignment.user_id).where(ShardAssignment.shard != None)
+    db.session.execute(insert(versions).from_select(
+        ['user_id', 'data_version', 'data_modified'],
+        select(user.c.id, user.c.data_version, user.c.data_modified)
+        .where(user.c.id.not_in(select(versions.c.user_id)), user.c.id.not_in(moved))))
+    db.session.commit()
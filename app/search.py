@@ -0,0 +1,69 @@
+import re
+from sqlalchemy import DDL, event, text, inspect
+from app import db
+from .models import Task
+
+# task_fts mirrors task.name through triggers, so every write path keeps it current. The owner column
+# holds a 'u<user_id>' token that scopes a MATCH to one user inside the full-text index itself.
+FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5(name, owner, tokenize = 'unicode61 remove_diacritics 2', "
+    "prefix = '2 3')",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON task BEGIN "
+    "INSERT INTO task_fts (rowid, name, owner) VALUES (new.id, new.name, 'u' || new.user_id); END",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON task BEGIN "
+    "DELETE FROM task_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF name, user_id ON task BEGIN "
+    "UPDATE task_fts SET name = new.name, owner = 'u' || new.user_id WHERE rowid = old.id; END",
+]
+
+SEARCH_SQL = text("SELECT task.* FROM task_fts JOIN task ON task.id = task_fts.rowid "
+                  "WHERE task_fts MATCH :query ORDER BY bm25(task_fts, 1.0, 0.0), task.id LIMIT :limit")
+
+_fts5_available = {}
+
+
+def has_fts5(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    key = str(connection.engine.url)
+    if key not in _fts5_available:
+        options = [row[0] for row in connection.exec_driver_sql('PRAGMA compile_options')]
+        _fts5_available[key] = 'ENABLE_FTS5' in options
+    return _fts5_available[key]
+
+
+def _fts5_enabled(ddl, target, bind, **kw):
+    return has_fts5(bind)
+
+
+for statement in FTS_DDL:
+    event.listen(Task.__table__, 'after_create', DDL(statement).execute_if(callable_=_fts5_enabled))
+event.listen(Task.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS task_fts').execute_if(dialect='sqlite'))
+
+
+def create_search_index(engine=None):
+    # For databases whose task table predates the search index: create it and fill it from the tasks
+    with (engine or db.engine).begin() as connection:
+        if not has_fts5(connection) or inspect(connection).has_table('task_fts'):
+            return
+        for statement in FTS_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("INSERT INTO task_fts (rowid, name, owner) SELECT id, name, 'u' || user_id FROM task")
+
+
+def search_tasks(user_id, query, limit=50):
+    """Return the user's tasks whose names contain words starting with each word of `query`, best match first."""
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if not words:
+        return []
+
+    if has_fts5(db.session.connection()):
+        match = 'owner : u{} AND '.format(user_id) + ' AND '.join('name : "{}"*'.format(w) for w in words)
+        return Task.query.from_statement(SEARCH_SQL).params(query=match, limit=limit).all()
+
+    tasks = Task.query.filter(Task.user_id == user_id)
+    for word in words:
+        # \w matches the underscore, which LIKE would otherwise treat as a wildcard
+        escaped = word.replace('%', '\\%').replace('_', '\\_')
+        tasks = tasks.filter(Task.name.ilike('%{}%'.format(escaped), escape='\\'))
+    return tasks.order_by(Task.complete, Task.start_date.desc()).limit(limit).all()
@@ -0,0 +1,329 @@
+import time
+from datetime import datetime
+from itertools import chain
+from flask import current_app, has_app_context
+from sqlalchemy import event, select, insert, update, delete, func
+from sqlalchemy.orm.attributes import instance_state
+from werkzeug.exceptions import ServiceUnavailable
+from app import db
+from .database import is_sharded
+from .identity import get_identity_cache
+from .models import User, Task, ArchivedTask, Project, TaskChange, UserVersion, ShardAssignment, IdSequence, \
+    IdBlock
+from .search import create_search_index
+
+# Moved with their user; the change log is rewritten on the target instead, see move_user
+MOVED_TABLES = (Task.__table__, ArchivedTask.__table__, Project.__table__, UserVersion.__table__)
+
+
+def shard_names():
+    return sorted(current_app.config['SHARDS'])
+
+
+def engine_for(shard):
+    # None stands for the main database, where users stay until they are first moved to a shard
+    return db.engine if shard is None else db.get_engine(bind=shard)
+
+
+def shard_for(user_id):
+    """Return the shard holding the user's tasks, or None while they are in the main database."""
+    row = db.session.execute(select(ShardAssignment.shard, ShardAssignment.moving)
+                             .where(ShardAssignment.user_id == user_id)).first()
+    if row is None:
+        return None
+    if row.moving:
+        raise moving_error()
+    return row.shard
+
+
+def moving_error():
+    return ServiceUnavailable('Your tasks are being moved, please try again shortly',
+                              retry_after=current_app.config['SHARD_MOVE_GRACE'] + 1)
+
+
+def select_shard(shard):
+    """Route the session's statements on sharded tables to `shard` until the session is removed."""
+    session = db.session()
+    if session.info.get('shard') == shard:
+        return
+    if any(is_sharded(type(obj).__table__) for obj in chain(session.new, session.dirty, session.deleted)):
+        raise RuntimeError('Commit pending task changes before switching to another shard')
+    # Task ids are only unique within a shard, so objects loaded from the previous one are let go
+    for obj in list(session.identity_map.values()):
+        if is_sharded(type(obj).__table__):
+            session.expunge(obj)
+    session.info['shard'] = shard
+
+
+def use_shard(user_id):
+    """Select the shard holding `user_id`'s tasks; does nothing unless SHARDS is set."""
+    if current_app.config['SHARDS']:
+        select_shard(shard_for(user_id))
+
+
+def route_snapshot(snapshot):
+    """Select the shard recorded in an app.identity snapshot, which spares use_shard's assignment query."""
+    if current_app.config['SHARDS']:
+        if snapshot.moving:
+            raise moving_error()
+        select_shard(snapshot.shard)
+
+
+def each_shard(user_id=None):
+    """Select in turn every database holding tasks of `user_id` or, without one, of any user."""
+    if not current_app.config['SHARDS']:
+        yield None
+    elif user_id is not None:
+        use_shard(user_id)
+        yield db.session.info.get('shard')
+    else:
+        for shard in [None] + shard_names():
+            select_shard(shard)
+            yield shard
+
+
+@event.listens_for(db.session, 'after_flush')
+def assign_shards(session, flush_context):
+    # New users start out on a shard; those from before sharding stay in the main database until moved
+    users = [u.id for u in session.new if isinstance(u, User)]
+    if users and has_app_context() and current_app.config['SHARDS']:
+        names = shard_names()
+        session.execute(insert(ShardAssignment.__table__),
+                        [{'user_id': user_id, 'shard': names[user_id % len(names)]} for user_id in users])
+
+
+def take_ids(connection, name, count):
+    """Take `count` consecutive ids from the main database's `name` sequence and return them as a range."""
+    sequence = IdSequence.__table__
+    updated = connection.execute(update(sequence).where(sequence.c.name == name)
+                                 .values(next_id=sequence.c.next_id + count)).rowcount
+    if not updated:
+        raise RuntimeError('There is no {} id sequence; run db_shard.py --provision'.format(name))
+    end = connection.execute(select(sequence.c.next_id).where(sequence.c.name == name)).scalar()
+    return range(end - count, end)
+
+
+def reserve_ids(session, name, count):
+    """Return a range of `count` ids for new `name` rows on the session's shard, unique across all databases.
+
+    Shards hand out ids from a block of SHARD_ID_BLOCK_SIZE they claim from the main database's sequence,
+    in a short transaction of its own, once the previous block runs out; so task writes only lock their
+    shard. Ids are taken in the session's transaction, so a rollback returns them. The main database takes
+    its ids from the sequence directly.
+    """
+    if session.info.get('shard') is None:
+        return take_ids(session, name, count)
+    block = IdBlock.__table__
+    taken = session.execute(update(block).where(block.c.name == name, block.c.next_id + count <= block.c.end_id)
+                            .values(next_id=block.c.next_id + count)).rowcount
+    if taken:
+        end = session.execute(select(block.c.next_id).where(block.c.name == name)).scalar()
+        return range(end - count, end)
+    # What is left of the block is skipped; ids only need to be unique
+    with db.engine.begin() as connection:
+        claimed = take_ids(connection, name, max(count, current_app.config['SHARD_ID_BLOCK_SIZE']))
+    updated = session.execute(update(block).where(block.c.name == name)
+                              .values(next_id=claimed.start + count, end_id=claimed.stop)).rowcount
+    if not updated:
+        raise RuntimeError('There is no {} id block on shard {}; run db_shard.py --provision'
+                           .format(name, session.info['shard']))
+    return range(claimed.start, claimed.start + count)
+
+
+@event.listens_for(db.session, 'before_flush')
+def allocate_task_ids(session, flush_context, instances):
+    # Each shard would number its tasks from 1, so with SHARDS set task ids come from disjoint ranges of
+    # one sequence instead. Users then keep their task ids when moved onto a shard holding other users.
+    tasks = [obj for obj in session.new if isinstance(obj, Task) and obj.id is None]
+    if tasks and has_app_context() and current_app.config['SHARDS']:
+        tasks.sort(key=lambda task: instance_state(task).insert_order)
+        for task, id in zip(tasks, reserve_ids(session, 'task', len(tasks))):
+            task.id = id
+
+
+def provision_shards():
+    """Create the sharded tables, their indexes and the search index on every shard still missing them.
+
+    The task id sequence is started, or moved, past every task id already in use on any database, and
+    shards without a block of task ids claim their first one.
+    """
+    tables = [table for table in db.metadata.sorted_tables if is_sharded(table)]
+    for shard in shard_names():
+        engine = engine_for(shard)
+        db.metadata.create_all(engine, tables=tables)
+        for table in tables:
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+        create_search_index(engine)
+
+    start = 1
+    for shard in [None] + shard_names():
+        with engine_for(shard).connect() as connection:
+            for table in (Task.__table__, ArchivedTask.__table__):
+                start = max(start, (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1)
+    sequence = db.session.get(IdSequence, 'task')
+    if sequence is None:
+        db.session.add(IdSequence(name='task', next_id=start))
+    else:
+        sequence.next_id = max(sequence.next_id, start)
+    db.session.commit()
+
+    block = IdBlock.__table__
+    for shard in shard_names():
+        with engine_for(shard).begin() as connection:
+            if connection.execute(select(block.c.name).where(block.c.name == 'task')).first() is None:
+                with db.engine.begin() as main:
+                    ids = take_ids(main, 'task', current_app.config['SHARD_ID_BLOCK_SIZE'])
+                connection.execute(insert(block).values(name='task', next_id=ids.start, end_id=ids.stop))
+    return shard_names()
+
+
+def delete_user_rows(connection, user_id):
+    for table in MOVED_TABLES + (TaskChange.__table__,):
+        connection.execute(delete(table).where(table.c.user_id == user_id))
+
+
+def copy_user(source, target, user_id):
+    now = datetime.utcnow()
+    moved = {}
+    # The user is not routed to the target yet, so anything of theirs there is left from a failed attempt
+    delete_user_rows(target, user_id)
+    for table in MOVED_TABLES:
+        rows = [dict(row) for row in source.execute(select(table).where(table.c.user_id == user_id)).mappings()]
+        if table is Project.__table__:
+            for row in rows:
+                del row['id']
+        elif table is UserVersion.__table__:
+            # The version goes on from where it was, and moves past it as the change log restarts below
+            version = rows[0]['data_version'] if rows else 0
+            rows = [{'user_id': user_id, 'data_version': version + 1, 'data_modified': now}]
+        if rows:
+            target.execute(insert(table), rows)
+        moved[table] = rows
+    # Change log ids are a per-database sequence, so the log restarts with every task the user has
+    changes = [{'user_id': user_id, 'task_id': row['id'], 'operation': 'create', 'created_at': now}
+               for row in moved[Task.__table__]]
+    if changes:
+        target.execute(insert(TaskChange.__table__), changes)
+    return len(moved[Task.__table__])
+
+
+def purge_user(shard, user_id):
+    """Delete what is left of a user on a shard they have been moved off; safe to repeat."""
+    with engine_for(shard).begin() as connection:
+        delete_user_rows(connection, user_id)
+
+
+def move_user(user_id, target):
+    """Move a user's tasks, archived tasks and project summaries to the `target` shard and route them there.
+
+    The user's requests get a 503 during the move, which waits SHARD_MOVE_GRACE seconds for those already
+    running. Task ids are kept, as allocate_task_ids makes them unique across shards. Sync cursors do not
+    carry over: the user's change log starts again on the target, so clients have to sync from the
+    beginning. Returns the number of tasks moved.
+    """
+    if target not in current_app.config['SHARDS']:
+        raise KeyError('Unknown shard {}'.format(target))
+    if not get_identity_cache().shared:
+        # Page loads route by cached snapshots, which the move has to reach in every process
+        raise RuntimeError('Moving users needs an IDENTITY_CACHE_BACKEND shared by all server processes')
+    assignment = db.session.get(ShardAssignment, user_id)
+    if assignment is None:
+        assignment = ShardAssignment(user_id=user_id)
+        db.session.add(assignment)
+    source = assignment.shard
+    if source == target:
+        return 0
+    assignment.moving = True
+    db.session.commit()
+    time.sleep(current_app.config['SHARD_MOVE_GRACE'])
+
+    # The copy is committed on the target before the user is routed there, and only then removed from the
+    # source, so a failure at any step leaves the user's tasks complete where their assignment points
+    try:
+        with engine_for(source).connect() as source_connection, engine_for(target).begin() as target_connection:
+            moved = copy_user(source_connection, target_connection, user_id)
+        assignment.shard = target
+    finally:
+        assignment.moving = False
+        db.session.commit()
+    try:
+        purge_user(source, user_id)
+    except Exception:
+        current_app.logger.exception('User %s was moved to %s but is still on %s; run db_shard.py --purge',
+                                     user_id, target, source or 'main')
+    return moved
+
+
+def purge_strays():
+    """Delete the rows of users left on databases they were moved off, when the last step of a move failed.
+
+    Run it when no move is in progress. Returns {shard: user ids purged}, with None for the main database.
+    """
+    assignments = dict(db.session.execute(select(ShardAssignment.user_id, ShardAssignment.shard)).all())
+    db.session.commit()
+    purged = {}
+    for shard in [None] + shard_names():
+        with engine_for(shard).connect() as connection:
+            present = set()
+            for table in MOVED_TABLES + (TaskChange.__table__,):
+                present.update(connection.execute(select(table.c.user_id).distinct()).scalars())
+        # Users without an assignment are either in the main database or registering right now, so they stay
+        for user_id in sorted(u for u in present if u in assignments and assignments[u] != shard):
+            assignment = db.session.get(ShardAssignment, user_id)
+            stray = assignment is not None and not assignment.moving and assignment.shard != shard
+            db.session.commit()
+            if stray:
+                purge_user(shard, user_id)
+                purged.setdefault(shard, []).append(user_id)
+    return purged
+
+
+def shard_loads():
+    """Map each shard, and None for the main database, to {user id: task count} for the users it holds."""
+    loads = {shard: {} for shard in [None] + shard_names()}
+    assignments = dict(db.session.execute(select(ShardAssignment.user_id, ShardAssignment.shard)).all())
+    for user_id in db.session.execute(select(User.id)).scalars():
+        shard = assignments.get(user_id)
+        if shard in loads:
+            loads[shard][user_id] = 0
+    for shard, users in loads.items():
+        with engine_for(shard).connect() as connection:
+            counts = connection.execute(select(Task.user_id, func.count()).group_by(Task.user_id)).all()
+        for user_id, count in counts:
+            if user_id in users:
+                users[user_id] = count
+    return loads
+
+
+def plan_rebalance(loads):
+    """Return the (user id, source, target) moves that even out the task counts in `loads`.
+
+    Every user still in the main database is placed on the least loaded shard, heaviest users first.
+    Users are then moved from the most to the least loaded shard for as long as that narrows the gap.
+    """
+    users = {shard: dict(counts) for shard, counts in loads.items() if shard is not None}
+    if not users:
+        return []
+    totals = {shard: sum(counts.values()) for shard, counts in users.items()}
+    moves = []
+    for user_id, count in sorted(loads.get(None, {}).items(), key=lambda item: (-item[1], item[0])):
+        target = min(sorted(totals), key=totals.get)
+        moves.append((user_id, None, target))
+        users[target][user_id] = count
+        totals[target] += count
+
+    while True:
+        heaviest = max(sorted(totals), key=totals.get)
+        lightest = min(sorted(totals), key=totals.get)
+        gap = totals[heaviest] - totals[lightest]
+        # Moving a user who holds less than the whole gap always narrows it; the best halves it
+        candidates = [(user_id, count) for user_id, count in users[heaviest].items() if 0 < count < gap]
+        if not candidates:
+            return moves
+        user_id, count = min(candidates, key=lambda item: (abs(gap - 2 * item[1]), item[0]))
+        moves.append((user_id, heaviest, lightest))
+        del users[heaviest][user_id]
+        users[lightest][user_id] = count
+        totals[heaviest] -= count
+        totals[lightest] += count
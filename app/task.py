@@ -1,53 +1,312 @@
-import datetime
-from dateutil import parser
+"""Python client for the task REST API.
 
+    client = Client(HTTPTransport('http://localhost:5000'), 'jane', 'secret')
+    client.authenticate()
+    for task in client.tasks():
+        print(task.name, task.due_date)
+    with client.batch() as batch:
+        batch.create(Task('Water plants', due_date='2030-01-15'))
+        batch.update(42, complete=True)
 
-class Task(object):
+Transports send the requests: HTTPTransport keeps a pool of keep-alive connections to a server, while
+FlaskTransport calls an application in-process through its test client, without any network.
+"""
+import gzip
+import http.client
+import json
+import queue
+from base64 import b64encode
+from datetime import date, datetime, timezone
+from urllib.parse import urlencode, urlsplit, quote
+from .cache import TTLCache
+
+API_PREFIX = '/viortio/api/v1.0'
+# Methods the server can safely be sent twice, should a request be lost with its connection
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+def parse_datetime(value):
+    """Return `value` as a naive UTC datetime; the API's ISO text parses without dateutil, which handles the rest.
+
+    Values with a time zone, such as ISO text ending in Z, are converted to UTC before the zone is dropped.
+    """
+    if value is None:
+        return value
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            from dateutil import parser
+            value = parser.parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def encode_changes(changes):
+    return {field: value.isoformat(' ', 'seconds') if isinstance(value, date) else value
+            for field, value in changes.items()}
 
-    def __init__(self, name, due_date=None, start_date=None, project=None):
 
+class Task(object):
+    """A task as the API sees it. Dates are naive UTC datetimes; strings and dates given for them are converted."""
+    FIELDS = ('id', 'name', 'due_date', 'start_date', 'project', 'complete', 'recurrence')
+    DATETIME_FIELDS = ('due_date', 'start_date')
+    __slots__ = FIELDS
+
+    def __init__(self, name, due_date=None, start_date=None, project=None, complete=False, recurrence=None, id=None):
+        if name is None:
+            raise ValueError('Task name must be specified!')
+        self.id = id
         self.name = name
-        self.due_date = due_date
-        self.start_date = start_date
+        self.due_date = parse_datetime(due_date)
+        self.start_date = parse_datetime(start_date)
         self.project = project
+        self.complete = complete
+        self.recurrence = recurrence
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['name'], d.get('due_date'), d.get('start_date'), d.get('project'), d.get('complete', False),
+                   d.get('recurrence'), d.get('id'))
+
+    def to_dict(self):
+        """Payload for the create and update endpoints; unset fields are left out so the server defaults apply."""
+        d = {}
+        for field in self.FIELDS[1:]:
+            value = getattr(self, field)
+            if value is not None:
+                d[field] = value
+        return encode_changes(d)
+
+    def __eq__(self, other):
+        return isinstance(other, Task) and all(getattr(self, f) == getattr(other, f) for f in self.FIELDS)
+
+    def __repr__(self):
+        return '<Task {} {!r}>'.format(self.id, self.name)
+
 
-    @property
-    def name(self):
-        return self._name
-
-    @name.setter
-    def name(self, value):
-        if value is None:
-            raise ValueError("Task name must be specified!")
-        self._name = value
-
-    @property
-    def due_date(self):
-        return self._due_date
-
-    @due_date.setter
-    def due_date(self, value):
-        if value is not None:
-            dt = parser.parse(value)
-            self._due_date = dt.strftime('%Y-%m-%d')
-
-    @property
-    def start_date(self):
-        return self._start_date
-
-    @start_date.setter
-    def start_date(self, value):
-        if value is not None:
-            dt = parser.parse(value)
-            self._start_date = dt.strftime('%Y-%m-%d')
+class APIError(Exception):
+
+    def __init__(self, status, body):
+        super(APIError, self).__init__('{}: {}'.format(status, body[:200]))
+        self.status = status
+        self.body = body
+
+
+class HTTPTransport(object):
+    """Sends requests over a pool of up to `pool_size` keep-alive connections; safe to share between threads."""
+
+    def __init__(self, base_url, pool_size=4, timeout=30):
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(pool_size)
+
+    def request(self, method, path, headers, body=None):
+        try:
+            connection, reused = self._pool.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self.connection_class(self.host, timeout=self.timeout), False
+        try:
+            sent = False
+            try:
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                sent = True
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # The server may have closed an idle keep-alive connection. The request is resent once if it
+                # failed while sending, or is safe to repeat; otherwise the server may already have acted on it
+                if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                    raise
+                connection.close()
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+            data = response.read()
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
         else:
-            self._start_date = datetime.datetime.now().strftime('%Y-%m-%d')
+            try:
+                self._pool.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, response.headers, data
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class FlaskTransport(object):
+    """Sends requests to a Flask application in this process through its test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body=None):
+        rv = self.client.open(path, method=method, headers=headers, data=body)
+        return rv.status_code, rv.headers, rv.get_data()
+
+    def close(self):
+        pass
+
+
+class Batch(object):
+    """Operations collected by Client.batch and sent in as few requests as the server's batch limit allows.
+
+    After the block, `results` holds a Task, a deleted id or an APIError for every operation, in order.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.results = None
+
+    def create(self, task):
+        self.operations.append(dict(task.to_dict(), op='create'))
+
+    def update(self, id, **changes):
+        self.operations.append(dict(encode_changes(changes), op='update', id=id))
+
+    def delete(self, id):
+        self.operations.append({'op': 'delete', 'id': id})
+
+    def send(self):
+        self.results = []
+        size = self.client.batch_size
+        for start in range(0, len(self.operations), size):
+            chunk = self.operations[start:start + size]
+            for result in self.client.post('/tasks/batch', {'operations': chunk})['results']:
+                if 'task' in result:
+                    self.results.append(Task.from_dict(result['task']))
+                elif 'deleted' in result:
+                    self.results.append(result['deleted'])
+                else:
+                    self.results.append(APIError(result['status'], result.get('error', '')))
+        self.operations = []
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.send()
+
+
+class Client(object):
+    """Client for one user's tasks.
+
+    GET responses are kept in a local cache and revalidated with If-None-Match, so an unchanged list costs
+    the server a version lookup and a 304 instead of a query and a body. authenticate() swaps the password
+    for a token, which the server checks without hashing.
+    """
+
+    def __init__(self, transport, username, password=None, prefix=API_PREFIX, cache_size=256, cache_ttl=3600,
+                 batch_size=1000):
+        self.transport = transport
+        self.username = username
+        self.password = password
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.token = None
+
+    def authenticate(self):
+        self.token = None
+        self.token = self.get('/token', cached=False)['token']
+        return self.token
+
+    def headers(self):
+        credentials = (self.token, '') if self.token else (self.username, self.password or '')
+        encoded = b64encode('{}:{}'.format(*credentials).encode('utf-8')).decode('ascii')
+        return {'Authorization': 'Basic ' + encoded, 'Accept-Encoding': 'gzip', 'Accept': 'application/json'}
+
+    def request(self, method, path, payload=None, headers=None):
+        body = None
+        headers = dict(self.headers(), **(headers or {}))
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        status, response_headers, data = self.transport.request(method, self.prefix + path, headers, body)
+        if status == 401 and self.token and self.password:
+            # The token expired; get a new one with the password and try again
+            self.authenticate()
+            return self.request(method, path, payload, headers={k: v for k, v in headers.items()
+                                                                 if k != 'Authorization'})
+        if response_headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        if status >= 400:
+            raise APIError(status, data.decode('utf-8', 'replace'))
+        return status, response_headers, data
+
+    def get(self, path, cached=True, **params):
+        params['format'] = 'v2'
+        path = '{}?{}'.format(path, urlencode(sorted(params.items())))
+        entry = self.cache.get(path) if cached else None
+        status, headers, data = self.request('GET', path, headers={'If-None-Match': entry[0]} if entry else None)
+        if status == 304:
+            return entry[1]
+        value = json.loads(data)
+        if cached and headers.get('ETag'):
+            self.cache.set(path, (headers['ETag'], value))
+        return value
+
+    def post(self, path, payload=None):
+        return json.loads(self.request('POST', path + '?format=v2', payload)[2])
+
+    def pages(self, path, key):
+        """Tasks under `key` from every page of a paged list, following next_cursor to the end."""
+        params = {}
+        while True:
+            page = self.get(path, **params)
+            for t in page[key]:
+                yield Task.from_dict(t)
+            if not page.get('next_cursor'):
+                return
+            params['cursor'] = page['next_cursor']
+
+    def tasks(self):
+        return list(self.pages('/tasks', 'tasks'))
+
+    def completed(self):
+        return list(self.pages('/tasks/completed', 'completed'))
+
+    def projects(self):
+        return self.get('/projects')['projects']
+
+    def project_tasks(self, name):
+        return list(self.pages('/projects/' + quote(name, safe=''), 'tasks'))
+
+    def search(self, query, limit=None):
+        params = {'q': query} if limit is None else {'q': query, 'limit': limit}
+        # Search results are not covered by the change version, so they are never revalidated
+        return [Task.from_dict(t) for t in self.get('/search', cached=False, **params)['tasks']]
+
+    def agenda(self, view='today'):
+        return [Task.from_dict(t) for t in self.get('/agenda/' + view)['tasks']]
+
+    def create(self, task):
+        return Task.from_dict(self.post('/tasks/create', task.to_dict()))
+
+    def update(self, id, **changes):
+        return Task.from_dict(self.post('/tasks/update/{}'.format(id), encode_changes(changes)))
 
-    @property
-    def project(self):
-        return self._project
+    def delete(self, id):
+        return self.post('/tasks/delete/{}'.format(id))['deleted']
 
-    @project.setter
-    def project(self, value):
-        self._project = value
+    def batch(self):
+        return Batch(self)
 
+    def close(self):
+        self.transport.close()
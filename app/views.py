@@ -1,20 +1,54 @@
-from datetime import datetime
+import json
+import time
+from datetime import datetime, timezone
 from dateutil.parser import parse
-from flask import render_template, flash, redirect, url_for, session, request, g, jsonify, abort
+from flask import Blueprint, render_template, flash, redirect, url_for, session, request, g, jsonify, abort, Response, \
+    stream_with_context, current_app, has_app_context
 from flask_login import login_required, logout_user, login_user, current_user
 from flask_httpauth import HTTPBasicAuth
 from flask_babel import gettext
-from werkzeug.security import generate_password_hash, check_password_hash
-from app import app, db, lm
-from .task import Task
+from sqlalchemy import event, func
+from sqlalchemy.orm import load_only
+from werkzeug import security
+from app import db, lm
+from .cache import CredentialCache
+from .decorators import conditional, materialized
+from .fragments import cached_fragment, get_fragment_cache
+from .identity import load_snapshot
+from .profiling import profiled
+from .agenda import agenda_window, agenda_key, calendar_feed
+from .archive import restore_tasks
+from .pagination import keyset_merge
+from .recurrence import normalize_rule
+from .push import get_broker
+from .search import search_tasks
+from .sharding import use_shard, route_snapshot
 from .forms import TaskForm, LoginForm, RegistrationForm
-from .models import User, Task
+from .models import User, Task, ArchivedTask, TaskChange, Job
+from .jobs import enqueue
+
+web = Blueprint('web', __name__)
+api = Blueprint('api', __name__, url_prefix='/viortio/api/v1.0')
 
 auth = HTTPBasicAuth()
+generate_password_hash = profiled('password_hash', security.generate_password_hash)
+check_password_hash = profiled('password_hash', security.check_password_hash)
+
+
+def get_credential_cache():
+    cache = current_app.extensions.get('credential_cache')
+    if cache is None:
+        config = current_app.config
+        cache = CredentialCache(config['SECRET_KEY'], maxsize=config['CREDENTIAL_CACHE_SIZE'],
+                                ttl=config['CREDENTIAL_CACHE_TTL'])
+        current_app.extensions['credential_cache'] = cache
+    return cache
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
+
+@web.route('/', methods=['GET', 'POST'])
+@web.route('/index', methods=['GET', 'POST'])
 @login_required
+@materialized
 def index():
 
     if request.form.get('is_finished'):
@@ -23,34 +57,64 @@ def index():
         db.session.add(t)
         db.session.commit()
 
-    tasks = g.user.get_tasklist()
-    projects = [p[0] for p in g.user.get_projects()]
+    # The task list also changes when a future task's start date arrives
+    tasks = cached_fragment('tasklist', lambda: render_template('_tasklist.html', tasks=g.user.get_tasklist()),
+                            g.user.next_start_date())
+    projects = cached_fragment('projects',
+                               lambda: render_template('_projects.html', projects=g.user.get_project_summaries()))
 
     return render_template('index.html', tasks=tasks, projects=projects)
 
 
-@app.route('/completed', methods=['GET', 'POST'])
+@web.route('/completed', methods=['GET', 'POST'])
 @login_required
 def completed_tasks():
 
-    tasks = g.user.get_completed_tasks()
+    cursor = request.args.get('cursor')
+
+    def render():
+        sources = [(g.user.completed_tasks_query(), Task.start_date, Task.id),
+                   (g.user.archived_tasks_query(), ArchivedTask.start_date, ArchivedTask.id)]
+        tasks, next_cursor = keyset_merge(sources, cursor, current_app.config['COMPLETED_PER_PAGE'], descending=True)
+        return render_template('_completed.html', tasks=tasks, next_cursor=next_cursor)
+
+    try:
+        tasks = cached_fragment('completed', render, cursor)
+    except ValueError:
+        abort(404)
     return render_template('completed_tasks.html', tasks=tasks)
 
 
+@web.route('/search', methods=['GET'])
+@login_required
+def search():
+
+    query = request.args.get('q', '')
+    tasks = search_tasks(g.user.id, query, current_app.config['SEARCH_RESULTS']) if query else []
+    return render_template('search.html', tasks=tasks, query=query, title='Search')
+
+
 @lm.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # An immutable snapshot from app.identity; most page loads find it cached and skip the user query
+    user = load_snapshot(int(id))
+    if user is not None:
+        route_snapshot(user)
+    return user
 
 
-@app.before_request
+@web.before_app_request
 def before_request():
     g.user = current_user
+    # Looked up again by app.identity.current_version for each request
+    g.user_version = None
+    g.user_changed = False
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@web.route('/login', methods=['GET', 'POST'])
 def login():
     if g.user is not None and g.user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('web.index'))
 
     form = LoginForm()
     if form.validate_on_submit():
@@ -59,26 +123,26 @@ def login():
 
         if u is None:
             flash('Username or password is invalid')
-            return redirect(url_for('login'))
+            return redirect(url_for('web.login'))
         if check_password_hash(u.password_hash, form.password.data):
             login_user(u, remember=form.remember_me.data)
             flash('Login successful')
-            return redirect(url_for('index'))
+            return redirect(url_for('web.index'))
         else:
             flash('Username or password is invalid')
-            return redirect(url_for('login'))
+            return redirect(url_for('web.login'))
 
     return render_template('login.html', title='Sign In', form=form)
 
 
-@app.route('/logout')
+@web.route('/logout')
 def logout():
     logout_user()
     flash('You were logged out')
-    return redirect(url_for('index'))
+    return redirect(url_for('web.index'))
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@web.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegistrationForm()
 
@@ -87,12 +151,12 @@ def register():
         db.session.add(u)
         db.session.commit()
         flash('You have been registered')
-        return redirect(url_for('login'))
+        return redirect(url_for('web.login'))
 
     return render_template('register.html', form=form, title='Create an account')
 
 
-@app.route('/addtask', methods=['GET', 'POST'])
+@web.route('/addtask', methods=['GET', 'POST'])
 @login_required
 def add_task():
 
@@ -101,17 +165,19 @@ def add_task():
         sd = form.start_date.data if form.start_date.data else datetime.utcnow()
         project = form.project.data if form.project.data else None
 
-        t = Task(name=form.task.data, due_date=form.due_date.data, user_id=g.user.id, start_date=sd, project=project)
+        t = Task(name=form.task.data, due_date=form.due_date.data, user_id=g.user.id, start_date=sd, project=project,
+                 recurrence=normalize_rule(form.recurrence.data))
         db.session.add(t)
         db.session.commit()
         flash(gettext('Task added!'))
-        return redirect(url_for('index'))
+        return redirect(url_for('web.index'))
 
     return render_template('addtask.html', form=form)
 
 
-@app.route('/project/<project_name>', methods=['GET', 'POST'])
+@web.route('/project/<project_name>', methods=['GET', 'POST'])
 @login_required
+@materialized
 def project(project_name):
 
     if request.form.get('is_finished'):
@@ -120,21 +186,34 @@ def project(project_name):
         db.session.add(t)
         db.session.commit()
 
-    project_tasks = Task.query.filter_by(project=project_name, complete=False).order_by('start_date').all()
+    project_tasks = cached_fragment('project', lambda: render_template(
+        '_tasklist.html', tasks=g.user.get_project_tasks(project_name)), project_name)
     return render_template('project.html', tasks=project_tasks, title=project_name)
 
 
-@app.errorhandler(404)
+@web.route('/admin/metrics', methods=['GET'])
+@auth.login_required
+def metrics():
+    if g.user.nickname not in current_app.config['ADMIN_USERS']:
+        abort(403)
+    fragments = get_fragment_cache()
+    return jsonify({'profiling': current_app.config['PROFILING'],
+                    'endpoints': current_app.extensions['profiling'].to_dict(),
+                    'credential_cache': get_credential_cache().stats(),
+                    'fragment_cache': fragments.stats() if fragments is not None else None})
+
+
+@web.app_errorhandler(404)
 def file_not_found(error):
     return render_template('404.html'), 404
 
-@app.errorhandler(500)
+@web.app_errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('500.html'), 500
 
 # Creating a REST API
-@app.route('/viortio/api/v1.0/users/<int:id>', methods=['GET'])
+@api.route('/users/<int:id>', methods=['GET'])
 def get_user(id):
     u = User.query.get(id)
     if not u:
@@ -142,7 +221,7 @@ def get_user(id):
     return jsonify({'username': u.nickname})
 
 
-@app.route('/viortio/api/v1.0/register', methods=['POST'])
+@api.route('/register', methods=['POST'])
 def register_user():
     username = request.json.get('username')
     password = request.json.get('password')
@@ -156,41 +235,166 @@ def register_user():
     db.session.add(user)
     db.session.commit()
 
-    return (jsonify({'username': user.nickname}), 201, {'Location': url_for('get_user', id=user.id, _external=True)})
+    return (jsonify({'username': user.nickname}), 201,
+            {'Location': url_for('api.get_user', id=user.id, _external=True)})
+
+def requested_fields():
+    available = Task.FIELDS if request.args.get('format') == 'v2' else Task.V1_FIELDS
+    fields = request.args.get('fields')
+    if not fields:
+        return available
+    fields = tuple(f for f in fields.split(',') if f)
+    if not fields or any(f not in available for f in fields):
+        abort(400)
+    return fields
+
+
+def serialize(task, fields=None):
+    # v1 responses embed each task as a JSON string; ?format=v2 emits plain objects in a single encoding pass
+    if request.args.get('format') == 'v2':
+        return task.to_dict(fields or Task.FIELDS)
+    return task.to_JSON(fields or Task.V1_FIELDS)
+
+
+def task_list(*queries, descending=False):
+    # Serializes one keyset page of task queries honouring the ?fields=, ?limit= and ?cursor= arguments;
+    # without a limit the page holds API_PAGE_SIZE tasks. v1 requests with neither argument come from
+    # clients that predate paging, so they get the whole list, without a next_cursor, as before. Several
+    # queries, such as live and archived tasks, are merged into one list.
+    fields = requested_fields()
+    sources = []
+    for query in queries:
+        entity = query.column_descriptions[0]['entity']
+        query = query.options(load_only(*[getattr(entity, f) for f in set(fields) | {'id', 'start_date'}]))
+        sources.append((query, entity.start_date, entity.id))
+
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit', type=int)
+    if cursor is None and limit is None and request.args.get('format') != 'v2':
+        return [serialize(t, fields) for t in keyset_merge(sources, limit=None, descending=descending)[0]], {}
+
+    limit = min(limit or current_app.config['API_PAGE_SIZE'], current_app.config['API_MAX_PAGE_SIZE'])
+    if limit < 1:
+        abort(400)
+    try:
+        tasks, next_cursor = keyset_merge(sources, cursor, limit, descending)
+    except ValueError:
+        abort(400)
+    return [serialize(t, fields) for t in tasks], {'next_cursor': next_cursor}
 
-@app.route('/viortio/api/v1.0/tasks', methods=['GET'])
+
+@api.route('/tasks', methods=['GET'])
 @auth.login_required
+@conditional(lambda: g.user.next_start_date())
+@materialized
 def get_tasks():
-    tasks = [t.to_JSON() for t in g.user.get_tasklist()]
-    return jsonify({'tasks': tasks})
+    tasks, page = task_list(g.user.tasklist_query())
+    return jsonify(tasks=tasks, **page)
 
 @auth.verify_password
 def verify_password(username, password):
+    g.token_auth = False
+    if username and not password:
+        return verify_token(username)
+
+    credential_cache = get_credential_cache()
+    cached = credential_cache.lookup(username, password)
+    if cached is not None:
+        u = User.query.get(cached[0])
+        if u is not None and u.nickname == username and u.password_hash == cached[1]:
+            g.user = u
+            use_shard(u.id)
+            return True
+        credential_cache.forget_user(cached[0])
+
     u = User.query.filter_by(nickname=username).first()
     if not u or not check_password_hash(u.password_hash, password):
         return False
+    credential_cache.remember(username, password, u.id, u.password_hash)
     g.user = u
+    use_shard(u.id)
     return True
 
 
-@app.route('/viortio/api/v1.0/tasks/create', methods=['POST'])
+def verify_token(token):
+    u = User.verify_auth_token(token)
+    if u is None:
+        return False
+    g.user = u
+    g.token_auth = True
+    use_shard(u.id)
+    return True
+
+
+@api.route('/token', methods=['GET'])
+@auth.login_required
+def get_auth_token():
+    # Only a password can mint a token, so a leaked token cannot be renewed indefinitely
+    if g.token_auth:
+        abort(403)
+    token = g.user.generate_auth_token()
+    return jsonify({'token': token, 'duration': current_app.config['TOKEN_EXPIRATION']})
+
+
+@event.listens_for(User.password_hash, 'set')
+def forget_credentials(target, value, oldvalue, initiator):
+    if target.id is not None and value != oldvalue and has_app_context():
+        get_credential_cache().forget_user(target.id)
+
+
+def parse_date(value):
+    # Dates are stored as naive UTC, so one given with a zone is converted to UTC and the zone dropped
+    value = parse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def task_changes(data):
+    # Task attributes present in an API payload; raises ValueError or TypeError on a value of the wrong
+    # type, or a malformed date or recurrence rule. An empty recurrence stops the task repeating.
+    changes = {}
+    for field, kind, description in (('name', str, 'a string'), ('project', str, 'a string'),
+                                     ('complete', bool, 'true or false')):
+        value = data.get(field)
+        if value is not None and not isinstance(value, kind):
+            raise TypeError('{} must be {}'.format(field, description))
+        if value:
+            changes[field] = value
+    for field in ('due_date', 'start_date'):
+        if data.get(field):
+            changes[field] = parse_date(data[field])
+    if 'recurrence' in data:
+        changes['recurrence'] = normalize_rule(data['recurrence'])
+    return changes
+
+
+def new_task(data):
+    if not isinstance(data.get('name'), str):
+        raise ValueError('Task name must be specified')
+    changes = task_changes(data)
+    changes['name'] = data['name']
+    changes.setdefault('start_date', datetime.utcnow())
+    return Task(user_id=g.user.id, **changes)
+
+
+@api.route('/tasks/create', methods=['POST'])
 @auth.login_required
 def create_task():
-    if not request.json or not 'name' in request.json:
+    if not isinstance(request.json, dict) or not 'name' in request.json:
         abort(400)
 
-    due_date = parse(request.json.get('due_date')) if request.json.get('due_date') else None
-    start_date = parse(request.json.get('start_date')) if request.json.get('start_date') else datetime.utcnow()
-
-    t = Task(name=request.json.get('name'), due_date=due_date, start_date=start_date,
-             project=request.json.get('project', None), user_id=g.user.id)
+    try:
+        t = new_task(request.json)
+    except (ValueError, TypeError, OverflowError):
+        abort(400)
 
     db.session.add(t)
     db.session.commit()
 
-    return jsonify(t.to_JSON()), 201
+    return jsonify(serialize(t)), 201
 
-@app.route('/viortio/api/v1.0/tasks/update/<int:id>', methods=['POST'])
+@api.route('/tasks/update/<int:id>', methods=['POST'])
 @auth.login_required
 def update_task(id):
 
@@ -198,24 +402,22 @@ def update_task(id):
 
     if t is None:
         abort(404)
+    if not isinstance(request.json, dict):
+        abort(400)
 
-    if request.json.get('name'):
-        t.name = request.json.get('name')
-    if request.json.get('due_date'):
-        t.due_date = parse(request.json.get('due_date'))
-    if request.json.get('start_date'):
-        t.start_date = parse(request.json.get('start_date'))
-    if request.json.get('project'):
-        t.project = request.json.get('project')
-    if request.json.get('complete'):
-        t.complete = request.json.get('complete')
+    try:
+        changes = task_changes(request.json)
+    except (ValueError, TypeError, OverflowError):
+        abort(400)
+    for field, value in changes.items():
+        setattr(t, field, value)
 
     db.session.commit()
 
-    return jsonify(t.to_JSON()), 201
+    return jsonify(serialize(t)), 201
 
 
-@app.route('/viortio/api/v1.0/tasks/delete/<int:id>', methods=['POST'])
+@api.route('/tasks/delete/<int:id>', methods=['POST'])
 @auth.login_required
 def delete_task(id):
 
@@ -229,23 +431,279 @@ def delete_task(id):
     return jsonify({'deleted': id}), 201
 
 
-@app.route('/viortio/api/v1.0/tasks/completed', methods=['GET'])
+@api.route('/tasks/restore/<int:id>', methods=['POST'])
+@auth.login_required
+def restore_task(id):
+
+    if not restore_tasks(g.user.id, [id]):
+        abort(404)
+    t = Task.query.get(id)
+    return jsonify({'task': serialize(t)}), 201
+
+
+@api.route('/tasks/archive', methods=['POST'])
+@auth.login_required
+def archive_completed_tasks():
+    # Archiving can move many rows, so it runs on the job worker; poll the returned job for its status
+    days = (request.get_json(silent=True) or {}).get('days')
+    if days is not None and (not isinstance(days, int) or days < 0):
+        abort(400)
+    j = enqueue('archive_tasks', owner=g.user.id, days=days, user_id=g.user.id)
+    db.session.commit()
+    return jsonify({'job': j.to_dict()}), 202
+
+
+@api.route('/jobs/<int:id>', methods=['GET'])
+@auth.login_required
+def get_job(id):
+    j = Job.query.filter_by(id=id, user_id=g.user.id).first()
+    if j is None:
+        abort(404)
+    return jsonify({'job': j.to_dict()})
+
+
+@api.route('/tasks/batch', methods=['POST'])
 @auth.login_required
+def batch_tasks():
+    # Applies a list of create/update/delete operations in a single transaction. Each operation
+    # gets its own result, so a bad item is reported without rejecting the rest of the batch.
+    operations = request.json.get('operations') if isinstance(request.json, dict) else None
+    if not isinstance(operations, list):
+        abort(400)
+    if len(operations) > current_app.config['API_MAX_BATCH_SIZE']:
+        abort(413)
+
+    ids = [op.get('id') for op in operations if isinstance(op, dict) and isinstance(op.get('id'), int)]
+    existing = {t.id: t for t in Task.query.filter(Task.user_id == g.user.id, Task.id.in_(ids))} if ids else {}
+
+    results = []
+    created = []
+    for op in operations:
+        kind = op.get('op') if isinstance(op, dict) else None
+        try:
+            if kind == 'create':
+                t = new_task(op)
+                created.append(t)
+                results.append({'status': 201, 'task': t})
+            elif kind in ('update', 'delete'):
+                t = existing.get(op.get('id'))
+                if t is None:
+                    results.append({'status': 404, 'error': 'Task not found'})
+                elif kind == 'update':
+                    for field, value in task_changes(op).items():
+                        setattr(t, field, value)
+                    results.append({'status': 200, 'task': t})
+                else:
+                    db.session.delete(t)
+                    del existing[t.id]
+                    results.append({'status': 200, 'deleted': t.id})
+            else:
+                results.append({'status': 400, 'error': 'Unknown operation'})
+        except (ValueError, TypeError, OverflowError) as e:
+            results.append({'status': 400, 'error': str(e)})
+
+    db.session.add_all(created)
+    db.session.flush()
+    # Serialize before committing so that created ids are known without reloading expired rows
+    for result in results:
+        if 'task' in result:
+            result['task'] = serialize(result['task'])
+    db.session.commit()
+
+    return jsonify({'results': results}), 200
+
+
+@api.route('/tasks/completed', methods=['GET'])
+@auth.login_required
+@conditional()
 def get_completed_tasks():
-    tasks = [t.to_JSON() for t in g.user.get_completed_tasks()]
-    return jsonify({'completed': tasks})
+    tasks, page = task_list(g.user.completed_tasks_query(), g.user.archived_tasks_query(), descending=True)
+    return jsonify(completed=tasks, **page)
+
+
+@api.route('/tasks/export', methods=['GET'])
+@auth.login_required
+def export_tasks():
+    # Streams every task, live then archived, as newline-delimited JSON; rows are fetched in batches from
+    # a server-side cursor so memory use does not grow with the size of the user's history
+    fields = requested_fields()
+    queries = [entity.query.filter_by(user_id=g.user.id).order_by(entity.id)
+               .options(load_only(*[getattr(entity, f) for f in set(fields) | {'id'}]))
+               .execution_options(stream_results=True).yield_per(current_app.config['EXPORT_BATCH_SIZE'])
+               for entity in (Task, ArchivedTask)]
+
+    def generate():
+        for query in queries:
+            for t in query:
+                yield json.dumps(t.to_dict(fields), sort_keys=True) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=tasks.ndjson'})
+
+
+def collapse_changes(log):
+    # Several changes to one task collapse into its current state, ordered by its last change.
+    # Returns (last change id, payload) pairs, with tombstones for tasks that no longer exist.
+    latest = {}
+    for change in log:
+        latest.pop(change.task_id, None)
+        latest[change.task_id] = change
+    tasks = {t.id: t for t in Task.query.filter(Task.user_id == g.user.id, Task.id.in_(latest))} if latest else {}
+    missing = set(latest) - set(tasks)
+    if missing:
+        tasks.update((t.id, t) for t in g.user.archived_tasks_query().filter(ArchivedTask.id.in_(missing)))
+
+    changes = []
+    for task_id, change in latest.items():
+        if change.operation == 'delete' or task_id not in tasks:
+            changes.append((change.id, {'op': 'delete', 'id': task_id}))
+        else:
+            changes.append((change.id, {'op': change.operation, 'task': serialize(tasks[task_id])}))
+    return changes
+
+
+def agenda(start, end):
+    fields = requested_fields()
+    query = g.user.agenda_query(start, end).order_by(Task.due_date, Task.id) \
+        .options(load_only(*[getattr(Task, f) for f in set(fields) | {'id', 'due_date'}]))
+    return jsonify({'tasks': [serialize(t, fields) for t in query],
+                    'start': start.isoformat(' ', 'seconds') if start else None,
+                    'end': end.isoformat(' ', 'seconds') if end else None})
+
+
+@api.route('/agenda/<any(overdue, today, week):view>', methods=['GET'])
+@auth.login_required
+@conditional(lambda: agenda_key(g.user, request.view_args['view']))
+@materialized
+def get_agenda(view):
+    # Open tasks by due date; days run midnight to midnight UTC
+    return agenda(*agenda_window(view, datetime.utcnow()))
+
+
+@api.route('/agenda', methods=['GET'])
+@auth.login_required
+@conditional()
+@materialized
+def get_agenda_range():
+    try:
+        start, end = parse_date(request.args['start']), parse_date(request.args['end'])
+    except (KeyError, ValueError, OverflowError):
+        abort(400)
+    return agenda(start, end)
+
+
+@api.route('/calendar', methods=['GET', 'POST'])
+@auth.login_required
+def get_calendar_url():
+    # The feed URL never expires, so like a token it can only be obtained with the password. POST
+    # replaces it with a new URL, revoking the old one.
+    if g.token_auth:
+        abort(403)
+    user = db.session.get(User, g.user.id)
+    if request.method == 'POST':
+        user.reset_calendar_secret()
+    url = url_for('web.get_calendar', token=user.calendar_token(), _external=True)
+    db.session.commit()
+    return jsonify({'url': url}), 201 if request.method == 'POST' else 200
+
 
+@conditional()
+def calendar_response():
+    return Response(calendar_feed(g.user.id), mimetype='text/calendar')
 
-@app.route('/viortio/api/v1.0/projects', methods=['GET'])
+
+@web.route('/calendar/<token>.ics', methods=['GET'])
+def get_calendar(token):
+    # Calendar apps poll this; an unchanged feed costs the token check, one version lookup and a 304
+    user = User.verify_calendar_token(token)
+    if user is None:
+        abort(404)
+    g.user = user
+    use_shard(user.id)
+    return calendar_response()
+
+
+@api.route('/search', methods=['GET'])
+@auth.login_required
+def search_api():
+    query = request.args.get('q')
+    if not query:
+        abort(400)
+    config = current_app.config
+    limit = min(max(request.args.get('limit', config['SEARCH_RESULTS'], type=int), 1), config['API_MAX_PAGE_SIZE'])
+    return jsonify({'tasks': [serialize(t) for t in search_tasks(g.user.id, query, limit)]})
+
+
+@api.route('/sync', methods=['GET'])
+@auth.login_required
+def sync_tasks():
+    # Returns the current state of every task changed after ?since=<cursor>, with tombstones for
+    # deleted tasks, plus the cursor to pass on the next call
+    since = request.args.get('since', 0, type=int)
+    config = current_app.config
+    limit = min(request.args.get('limit', config['API_PAGE_SIZE'], type=int), config['API_MAX_PAGE_SIZE'])
+    if limit < 1:
+        abort(400)
+
+    log = TaskChange.query.filter(TaskChange.user_id == g.user.id, TaskChange.id > since) \
+        .order_by(TaskChange.id).limit(limit + 1).all()
+    more = len(log) > limit
+    log = log[:limit]
+
+    changes = [payload for _, payload in collapse_changes(log)]
+    return jsonify({'changes': changes, 'cursor': log[-1].id if log else since, 'more': more})
+
+
+@api.route('/events', methods=['GET'])
+@auth.login_required
+def task_events():
+    # Server-sent events stream of the user's task changes. The event id is the change log cursor, so a
+    # reconnecting EventSource resumes from Last-Event-ID; without one the stream starts from now.
+    user_id = g.user.id
+    last = request.headers.get('Last-Event-ID', type=int)
+    if last is None:
+        last = db.session.query(func.max(TaskChange.id)).filter_by(user_id=user_id).scalar() or 0
+    db.session.close()
+    broker = get_broker()
+    deadline = time.monotonic() + current_app.config['PUSH_STREAM_TIMEOUT']
+
+    def generate(last):
+        yield 'retry: {}\n\n'.format(current_app.config['PUSH_RETRY'])
+        while True:
+            log = TaskChange.query.filter(TaskChange.user_id == user_id, TaskChange.id > last) \
+                .order_by(TaskChange.id).limit(current_app.config['API_PAGE_SIZE']).all()
+            events = collapse_changes(log)
+            db.session.close()
+            for change_id, payload in events:
+                yield 'id: {}\nevent: task\ndata: {}\n\n'.format(change_id, json.dumps(payload, sort_keys=True))
+            if log:
+                last = log[-1].id
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if not broker.wait(user_id, last, min(current_app.config['PUSH_HEARTBEAT'], remaining)):
+                yield ': keep-alive\n\n'
+
+    return Response(stream_with_context(generate(last)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@api.route('/projects', methods=['GET'])
 @auth.login_required
+@conditional()
 def get_projects():
+    if request.args.get('format') == 'v2':
+        return jsonify({'projects': [p.to_dict() for p in g.user.get_project_summaries()]})
     projects = [p[0] for p in g.user.get_projects()]
     return jsonify({'projects': projects})
 
 
-@app.route('/viortio/api/v1.0/projects/<project_name>', methods=['GET'])
+@api.route('/projects/<project_name>', methods=['GET'])
 @auth.login_required
+@conditional()
+@materialized
 def get_tasks_for_project(project_name):
-    project_tasks = Task.query.filter_by(project=project_name, complete=False).order_by('start_date').all()
-    project_tasks = [t.to_JSON() for t in project_tasks]
-    return jsonify({'project': project_name, 'tasks': project_tasks})
+    project_tasks, page = task_list(g.user.project_tasks_query(project_name))
+    return jsonify(project=project_name, tasks=project_tasks, **page)
@@ -0,0 +1,278 @@
+"""Seed a database with synthetic users and tasks, drive every view and API endpoint and report latencies.
+
+    python benchmark.py --users 20 --tasks 2000 --requests 200 --output results.json
+    python benchmark.py --baseline results.json --tolerance 0.2    # exits 1 on a p95 regression
+
+Requests go through the Flask test client, or through a local threaded WSGI server with --server. Cold start,
+importing the package, building the app and serving its first page, is timed in fresh interpreters.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from base64 import b64encode
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from app import create_app, db
+from app.models import User, Task
+from app.projects import rebuild_projects
+
+PASSWORD = 'benchmark'
+WORDS = ('call', 'email', 'review', 'report', 'invoice', 'plan', 'meeting', 'draft', 'fix', 'buy', 'book', 'clean')
+
+# Run in a fresh interpreter by startup(); prints the milliseconds each phase took as JSON
+STARTUP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app(SQLALCHEMY_DATABASE_URI='sqlite://')
+created = time.perf_counter()
+status = app.test_client().get('/login').status_code
+served = time.perf_counter()
+print(json.dumps({'import_ms': (imported - start) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'first_request_ms': (served - created) * 1000, 'status': status}))
+'''
+
+
+def seed(users, tasks, projects, completed_ratio, rng):
+    """Insert `users` users with `tasks` tasks each and return their nicknames."""
+    password_hash = generate_password_hash(PASSWORD)
+    nicknames = ['bench{}'.format(i) for i in range(users)]
+    db.session.execute(User.__table__.insert(), [{'nickname': n, 'password_hash': password_hash} for n in nicknames])
+    ids = dict(db.session.query(User.nickname, User.id).filter(User.nickname.in_(nicknames)))
+
+    now = datetime.utcnow()
+    for nickname in nicknames:
+        rows = []
+        for i in range(tasks):
+            start = now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1440))
+            due = start + timedelta(days=rng.randint(1, 30)) if rng.random() < 0.5 else None
+            project = 'project{}'.format(rng.randrange(projects)) if projects and rng.random() < 0.8 else None
+            rows.append({'name': '{} {} {}'.format(rng.choice(WORDS), rng.choice(WORDS), i), 'user_id': ids[nickname],
+                         'start_date': start, 'due_date': due, 'project': project,
+                         'complete': rng.random() < completed_ratio})
+        db.session.execute(Task.__table__.insert(), rows)
+    db.session.commit()
+    # Bulk inserts bypass the ORM hooks that maintain the project summaries
+    rebuild_projects()
+    return nicknames
+
+
+def basic_auth(username, password):
+    return {'Authorization': 'Basic ' + b64encode('{}:{}'.format(username, password).encode('utf-8')).decode('ascii')}
+
+
+class TestClient(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers=None, payload=None, form=None):
+        rv = self.client.open(path, method=method, headers=headers, json=payload, data=form)
+        return rv.status_code, rv.get_data()
+
+
+class ServerClient(object):
+    """Keep-alive HTTP client against a threaded WSGI server serving the app on a free local port."""
+
+    def __init__(self, app):
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port)
+        self.cookies = SimpleCookie()
+
+    def request(self, method, path, headers=None, payload=None, form=None):
+        headers = dict(headers or {})
+        body = None
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(k, m.value) for k, m in self.cookies.items())
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        payload = response.read()
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            self.cookies.load(cookie)
+        return response.status, payload
+
+    def close(self):
+        self.connection.close()
+        self.server.shutdown()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, int(round(p / 100.0 * len(ordered))) - 1)]
+
+
+def summarize(durations):
+    total = sum(durations)
+    return {'requests': len(durations), 'throughput_rps': round(len(durations) / total, 2) if total else None,
+            'mean_ms': round(total / len(durations) * 1000, 3),
+            'p50_ms': round(percentile(durations, 50) * 1000, 3),
+            'p95_ms': round(percentile(durations, 95) * 1000, 3),
+            'p99_ms': round(percentile(durations, 99) * 1000, 3)}
+
+
+def measure(client, requests, method, path, **kwargs):
+    durations = []
+    responses = []
+    for i in range(requests):
+        options = {k: (v(i) if callable(v) else v) for k, v in kwargs.items()}
+        target = path(i) if callable(path) else path
+        start = time.perf_counter()
+        status, body = client.request(method, target, **options)
+        durations.append(time.perf_counter() - start)
+        if status >= 400:
+            raise RuntimeError('{} {} returned {}'.format(method, target, status))
+        responses.append(body)
+    return durations, responses
+
+
+def run(client, nickname, requests):
+    """Drive every web view and API endpoint `requests` times as `nickname` and return per-endpoint results."""
+    api = '/viortio/api/v1.0'
+    headers = basic_auth(nickname, PASSWORD)
+    project = 'project0'
+    results = {}
+
+    def bench(name, method, path, **kwargs):
+        durations, responses = measure(client, requests, method, path, **kwargs)
+        results[name] = summarize(durations)
+        return responses
+
+    client.request('POST', '/login', form={'username': nickname, 'password': PASSWORD})
+    bench('web.index', 'GET', '/index')
+    bench('web.completed', 'GET', '/completed')
+    bench('web.project', 'GET', '/project/' + project)
+    bench('web.search', 'GET', '/search?q=rev')
+
+    token = json.loads(client.request('GET', api + '/token', headers=headers)[1])['token']
+    token_headers = basic_auth(token, '')
+    bench('api.token', 'GET', api + '/token', headers=headers)
+    bench('api.tasks', 'GET', api + '/tasks', headers=headers)
+    bench('api.tasks.token', 'GET', api + '/tasks', headers=token_headers)
+    bench('api.tasks.page', 'GET', api + '/tasks?limit=50&format=v2', headers=token_headers)
+    bench('api.completed', 'GET', api + '/tasks/completed', headers=token_headers)
+    bench('api.projects', 'GET', api + '/projects', headers=token_headers)
+    bench('api.project_tasks', 'GET', api + '/projects/' + project, headers=token_headers)
+    bench('api.search', 'GET', api + '/search?q=inv', headers=token_headers)
+    bench('api.sync', 'GET', api + '/sync?since=0', headers=token_headers)
+    bench('api.export', 'GET', api + '/tasks/export', headers=token_headers)
+
+    created = bench('api.create', 'POST', api + '/tasks/create?format=v2', headers=token_headers,
+                    payload=lambda i: {'name': 'created {}'.format(i), 'project': project})
+    ids = [json.loads(body)['id'] for body in created]
+    bench('api.update', 'POST', lambda i: '{}/tasks/update/{}'.format(api, ids[i]), headers=token_headers,
+          payload={'name': 'updated'})
+    bench('api.batch', 'POST', api + '/tasks/batch', headers=token_headers,
+          payload=lambda i: {'operations': [{'op': 'create', 'name': 'batched {}'.format(j)} for j in range(10)]})
+    bench('api.delete', 'POST', lambda i: '{}/tasks/delete/{}'.format(api, ids[i]), headers=token_headers)
+    return results
+
+
+def startup(runs):
+    """Time a cold start `runs` times, each in a new interpreter, and return the mean of every phase."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for i in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=directory, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        if sample.pop('status') >= 400:
+            raise RuntimeError('First request failed during startup')
+        samples.append(sample)
+    return {phase: round(sum(s[phase] for s in samples) / runs, 3) for phase in samples[0]}
+
+
+def compare(results, baseline, tolerance):
+    """Return a message for every endpoint whose p95 latency exceeds the baseline by more than `tolerance`."""
+    regressions = []
+    for name, previous in baseline.get('endpoints', {}).items():
+        current = results['endpoints'].get(name)
+        if current and current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {}ms vs {}ms'.format(name, current['p95_ms'], previous['p95_ms']))
+    return regressions
+
+
+def run_benchmark(app, args):
+    rng = random.Random(args.seed)
+    db.create_all()
+    start = time.perf_counter()
+    nicknames = seed(args.users, args.tasks, args.projects, args.completed_ratio, rng)
+    seeded = time.perf_counter() - start
+
+    client = ServerClient(app) if args.server else TestClient(app)
+    try:
+        endpoints = run(client, nicknames[0], args.requests)
+    finally:
+        if args.server:
+            client.close()
+
+    return {'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+            'seed_seconds': round(seeded, 3), 'endpoints': endpoints,
+            'startup': startup(args.startup_runs) if args.startup_runs else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--tasks', type=int, default=1000, help='tasks per user')
+    parser.add_argument('--projects', type=int, default=10, help='projects per user')
+    parser.add_argument('--completed-ratio', type=float, default=0.5)
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='SQLAlchemy URI to seed; defaults to a temporary SQLite file')
+    parser.add_argument('--server', action='store_true', help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--startup-runs', type=int, default=5, help='cold starts to time; 0 skips them')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='viortio-bench-') as directory:
+        app = create_app(SQLALCHEMY_DATABASE_URI=args.database or 'sqlite:///' + os.path.join(directory, 'bench.db'),
+                         WTF_CSRF_ENABLED=False)
+        with app.app_context():
+            try:
+                report = run_benchmark(app, args)
+            finally:
+                # Close the pooled connections so the database file can be removed with the directory
+                db.session.remove()
+                db.engine.dispose()
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+import argparse
+from app import create_app
+from app.assets import build_assets
+
+app = create_app()
+
+parser = argparse.ArgumentParser(description='Fingerprint and precompress the static files for long-lived caching.')
+parser.add_argument('--output', default=app.config['ASSETS_DIR'], help='directory to write the assets to')
+args = parser.parse_args()
+
+manifest = build_assets(app.static_folder, args.output)
+print('Built {} assets in {}'.format(len(manifest), args.output))
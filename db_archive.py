@@ -0,0 +1,35 @@
+import argparse
+import time
+from app import create_app, db
+from app.archive import archive_tasks, restore_tasks
+from app.jobs import enqueue
+from app.sharding import each_shard, use_shard
+
+app = create_app()
+
+parser = argparse.ArgumentParser(description='Move old completed tasks to the archive table, or restore them.')
+parser.add_argument('--days', type=int, default=app.config['ARCHIVE_AFTER_DAYS'],
+                    help='archive tasks completed more than this many days ago')
+parser.add_argument('--user', type=int, help='only archive or restore this user id')
+parser.add_argument('--restore', type=int, nargs='*', metavar='TASK_ID',
+                    help="restore the user's archived tasks, or only the given ones")
+parser.add_argument('--loop', action='store_true', help='keep archiving every ARCHIVE_INTERVAL seconds')
+parser.add_argument('--enqueue', action='store_true', help='queue the archiving for worker.py instead of running it')
+args = parser.parse_args()
+app.app_context().push()
+
+if args.restore is not None:
+    if args.user is None:
+        parser.error('--restore requires --user')
+    use_shard(args.user)
+    print('Restored {} tasks'.format(restore_tasks(args.user, args.restore or None)))
+elif args.enqueue:
+    j = enqueue('archive_tasks', days=args.days, user_id=args.user)
+    db.session.commit()
+    print('Queued job {}'.format(j.id))
+else:
+    while True:
+        print('Archived {} tasks'.format(sum(archive_tasks(args.days, args.user) for _ in each_shard(args.user))))
+        if not args.loop:
+            break
+        time.sleep(app.config['ARCHIVE_INTERVAL'])
@@ -0,0 +1,37 @@
+import argparse
+from app import create_app
+from app.sharding import provision_shards, shard_loads, plan_rebalance, move_user, purge_strays
+
+app = create_app()
+
+parser = argparse.ArgumentParser(description='Provision the shards in SHARDS and move users between them.')
+parser.add_argument('--provision', action='store_true', help='create the sharded tables on every shard')
+parser.add_argument('--move', nargs=2, metavar=('USER_ID', 'SHARD'), help="move one user's tasks to a shard")
+parser.add_argument('--rebalance', action='store_true',
+                    help='move users off the main database, then even out the task counts of the shards')
+parser.add_argument('--dry-run', action='store_true', help='print the moves --rebalance would make')
+parser.add_argument('--purge', action='store_true',
+                    help='delete what moves that failed at their last step left on the database they moved from')
+args = parser.parse_args()
+app.app_context().push()
+
+if not app.config['SHARDS']:
+    parser.error('SHARDS is empty in the configuration')
+if args.provision:
+    print('Provisioned {}'.format(', '.join(provision_shards())))
+if args.move:
+    user_id, shard = int(args.move[0]), args.move[1]
+    print('Moved {} tasks of user {} to {}'.format(move_user(user_id, shard), user_id, shard))
+if args.rebalance:
+    for user_id, source, target in plan_rebalance(shard_loads()):
+        if args.dry_run:
+            print('Would move user {} from {} to {}'.format(user_id, source or 'main', target))
+        else:
+            print('Moved {} tasks of user {} from {} to {}'.format(move_user(user_id, target), user_id,
+                                                                   source or 'main', target))
+if args.purge:
+    for shard, users in purge_strays().items():
+        print('Removed users {} from {}'.format(', '.join(map(str, users)), shard or 'main'))
+if not (args.provision or args.move or args.rebalance or args.purge):
+    for shard, users in shard_loads().items():
+        print('{}: {} users, {} tasks'.format(shard or 'main', len(users), sum(users.values())))
@@ -1,3 +1,4 @@
-from app import app
+from app import create_app
 
+app = create_app()
 app.run(debug=True)
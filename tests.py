@@ -1,25 +1,56 @@
 import os
+import gzip
+import http.client
+import json
+import random
+import tempfile
 import unittest
-from datetime import datetime, timedelta
+from unittest import mock
+from base64 import b64encode
+from datetime import datetime, timedelta, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import benchmark
 from config import basedir
-from app import app, db
-from app.models import User, Task
+from app import create_app, db
+from app.models import User, Task, ArchivedTask, Project, TaskChange, Job, ShardAssignment, UserVersion, IdBlock
+from app.agenda import get_feed_cache
+from app.archive import archive_tasks, archivable_query
+from app.assets import build_assets
+from app.cache import FileSystemCache
+from app.identity import get_identity_cache, UserSnapshot
+from app.jobs import JOBS, job, enqueue, claim, run_job, requeue_stale, work
+from app.database import engine_options
+from app.fragments import get_fragment_cache
+from app.projects import rebuild_projects
+from app.push import get_broker, DatabaseBroker
+from app import search
+from app.search import search_tasks
+from app.task import Client, FlaskTransport, HTTPTransport, APIError, Task as ClientTask, parse_datetime
+from app.sharding import provision_shards, engine_for, copy_user, move_user, purge_strays, shard_loads, plan_rebalance, \
+    each_shard
+from app.pagination import encode_cursor, keyset_query
+from app.recurrence import materialize_occurrences
+from app.schema import upgrade_schema
+from app.views import get_credential_cache
 
 
 class ViortioTestCase(unittest.TestCase):
 
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
-        self.app = app.test_client()
+        # Every test gets its own application, so caches and brokers never carry over between tests
+        self.flask_app = create_app(TESTING=True, WTF_CSRF_ENABLED=False,
+                                    SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(basedir, 'test.db'))
+        self.context = self.flask_app.app_context()
+        self.context.push()
+        self.app = self.flask_app.test_client()
         db.create_all()
 
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        db.engine.dispose()
+        self.context.pop()
 
     def login(self, username, password):
         return self.app.post('/login', data=dict(username=username, password=password), follow_redirects=True)
@@ -37,6 +68,19 @@ class ViortioTestCase(unittest.TestCase):
     def project_page(self, project):
         return self.app.get('/project/{}'.format(project))
 
+    def query_plan(self, query):
+        statement = getattr(query, 'statement', query).compile(dialect=db.engine.dialect)
+        params = [statement.params[name] for name in statement.positiontup]
+        connection = db.engine.raw_connection()
+        try:
+            return [row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + str(statement), params)]
+        finally:
+            connection.close()
+
+    def api_headers(self, username, password):
+        credentials = b64encode('{}:{}'.format(username, password).encode('utf-8')).decode('ascii')
+        return {'Authorization': 'Basic ' + credentials}
+
     def test_user(self):
         password_hash = generate_password_hash('12345')
         u = User(nickname='Jane', password_hash=password_hash)
@@ -158,14 +202,1241 @@ class ViortioTestCase(unittest.TestCase):
         rv = self.project_page(project)
         assert b'task1 for project foo' in rv.data
 
-if __name__ == '__main__':
-    unittest.main()
+    def test_api_credential_cache(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+
+        headers = self.api_headers('Jane', '12345')
+        for _ in range(3):
+            rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+            assert rv.status_code == 200
+        credential_cache = get_credential_cache()
+        assert credential_cache.misses == 1
+        assert credential_cache.hits == 2
+
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=self.api_headers('Jane', 'wrong'))
+        assert rv.status_code == 401
+
+        u = User.query.filter_by(nickname='Jane').first()
+        u.password_hash = generate_password_hash('67890')
+        db.session.commit()
+        assert len(credential_cache) == 0
+
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+        assert rv.status_code == 401
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=self.api_headers('Jane', '67890'))
+        assert rv.status_code == 200
+
+    def test_api_token(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+
+        rv = self.app.get('/viortio/api/v1.0/token', headers=self.api_headers('Jane', '12345'))
+        assert rv.status_code == 200
+        token = rv.get_json()['token']
+
+        headers = self.api_headers(token, '')
+        rv = self.app.post('/viortio/api/v1.0/tasks/create', json={'name': 'token task'}, headers=headers)
+        assert rv.status_code == 201
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+        assert 'token task' in rv.get_data(as_text=True)
+
+        rv = self.app.get('/viortio/api/v1.0/token', headers=headers)
+        assert rv.status_code == 403
 
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=self.api_headers(token[:-2], ''))
+        assert rv.status_code == 401
 
+        expiration = self.flask_app.config['TOKEN_EXPIRATION']
+        self.flask_app.config['TOKEN_EXPIRATION'] = -1
+        try:
+            rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+            assert rv.status_code == 401
+        finally:
+            self.flask_app.config['TOKEN_EXPIRATION'] = expiration
 
+    def test_api_pagination(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        for i in range(7):
+            # Pairs of tasks share a start date so the id tie-breaker is exercised
+            db.session.add(Task(name='done{}'.format(i), user_id=u.id, start_date=now - timedelta(days=i // 2), complete=True))
+        db.session.commit()
+        expected = [t.name for t in u.get_completed_tasks()]
+        # Tasks without a start date come last in the descending completed list
+        undated = [Task(name='undated{}'.format(i), user_id=u.id, start_date=None, complete=True) for i in range(3)]
+        db.session.add_all(undated)
+        db.session.commit()
+        expected += sorted((t.name for t in undated), reverse=True)
 
+        headers = self.api_headers('Jane', '12345')
+        names, cursor = [], None
+        while True:
+            url = '/viortio/api/v1.0/tasks/completed?limit=3&fields=name'
+            if cursor:
+                url += '&cursor=' + cursor
+            rv = self.app.get(url, headers=headers)
+            assert rv.status_code == 200
+            page = [json.loads(t) for t in rv.get_json()['completed']]
+            assert all(list(t) == ['name'] for t in page)
+            names.extend(t['name'] for t in page)
+            cursor = rv.get_json()['next_cursor']
+            if cursor is None:
+                break
+        assert names == expected
+        assert len(names) == 10
+
+        # Without a limit v2 lists are paged, while v1 clients, which may not know about cursors, get everything
+        self.flask_app.config['API_PAGE_SIZE'] = 5
+        rv = self.app.get('/viortio/api/v1.0/tasks/completed?format=v2', headers=headers)
+        assert len(rv.get_json()['completed']) == 5 and rv.get_json()['next_cursor']
+        rv = self.app.get('/viortio/api/v1.0/tasks/completed', headers=headers)
+        assert [json.loads(t)['name'] for t in rv.get_json()['completed']] == expected
+        assert 'next_cursor' not in rv.get_json()
+
+        rv = self.app.get('/viortio/api/v1.0/tasks/completed?fields=password', headers=headers)
+        assert rv.status_code == 400
+        rv = self.app.get('/viortio/api/v1.0/tasks/completed?cursor=garbage', headers=headers)
+        assert rv.status_code == 400
+
+    def test_api_project_tasks_are_per_user(self):
+        jane = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        john = User(nickname='John')
+        db.session.add_all([jane, john])
+        db.session.commit()
+
+        db.session.add(Task(name='Jane foo', user_id=jane.id, start_date=datetime.utcnow(), project='foo'))
+        db.session.add(Task(name='John foo', user_id=john.id, start_date=datetime.utcnow(), project='foo'))
+        db.session.commit()
+
+        rv = self.app.get('/viortio/api/v1.0/projects/foo', headers=self.api_headers('Jane', '12345'))
+        assert [json.loads(t)['name'] for t in rv.get_json()['tasks']] == ['Jane foo']
+
+    def test_api_v2_format(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+
+        start = datetime(2017, 3, 4, 5, 6, 7, 890)
+        db.session.add(Task(name='task1', user_id=u.id, start_date=start, project='foo'))
+        db.session.commit()
+
+        headers = self.api_headers('Jane', '12345')
+        v1 = self.app.get('/viortio/api/v1.0/tasks', headers=headers).get_json()['tasks']
+        v2 = self.app.get('/viortio/api/v1.0/tasks?format=v2', headers=headers).get_json()['tasks']
+        assert v2[0]['start_date'] == start.strftime('%Y-%m-%d %H:%M:%S')
+        assert v2[0]['due_date'] is None
+        assert json.loads(v1[0]) == {f: v for f, v in v2[0].items() if f != 'recurrence'}
+
+        rv = self.app.post('/viortio/api/v1.0/tasks/create?format=v2', json={'name': 'task2'}, headers=headers)
+        assert rv.get_json()['name'] == 'task2'
+
+    def test_api_export(self):
+        jane = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        john = User(nickname='John')
+        db.session.add_all([jane, john])
+        db.session.commit()
+
+        db.session.add(Task(name='open', user_id=jane.id, start_date=datetime.utcnow()))
+        db.session.add(Task(name='done', user_id=jane.id, start_date=datetime.utcnow(), complete=True))
+        db.session.add(Task(name='later', user_id=jane.id, start_date=datetime.utcnow() + timedelta(days=3)))
+        db.session.add(Task(name='not mine', user_id=john.id, start_date=datetime.utcnow()))
+        db.session.commit()
+
+        rv = self.app.get('/viortio/api/v1.0/tasks/export', headers=self.api_headers('Jane', '12345'))
+        assert rv.status_code == 200
+        assert rv.mimetype == 'application/x-ndjson'
+        tasks = [json.loads(line) for line in rv.get_data(as_text=True).splitlines()]
+        assert [t['name'] for t in tasks] == ['open', 'done', 'later']
+        assert tasks[1]['complete'] is True
+
+    def test_api_batch(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+
+        keep = Task(name='keep', user_id=u.id, start_date=datetime.utcnow())
+        drop = Task(name='drop', user_id=u.id, start_date=datetime.utcnow())
+        db.session.add_all([keep, drop])
+        db.session.commit()
+        keep_id, drop_id = keep.id, drop.id
+
+        operations = [{'op': 'create', 'name': 'new task', 'project': 'foo'},
+                      {'op': 'create', 'name': 'bad date', 'due_date': 'not a date'},
+                      {'op': 'update', 'id': keep_id, 'name': 'kept', 'complete': True},
+                      {'op': 'delete', 'id': drop_id},
+                      {'op': 'delete', 'id': drop_id},
+                      {'op': 'rename'},
+                      {'op': 'create', 'name': 'x', 'complete': 'yes'},
+                      {'op': 'create', 'name': ['x']},
+                      {'op': 'update', 'id': keep_id, 'project': 7}]
+        headers = self.api_headers('Jane', '12345')
+        rv = self.app.post('/viortio/api/v1.0/tasks/batch?format=v2', json={'operations': operations},
+                           headers=headers)
+        assert rv.status_code == 200
+        results = rv.get_json()['results']
+        assert [r['status'] for r in results] == [201, 400, 200, 200, 404, 400, 400, 400, 400]
+        assert results[6]['error'] == 'complete must be true or false'
+        assert results[0]['task']['name'] == 'new task'
+        assert results[3]['deleted'] == drop_id
+
+        assert Task.query.get(results[0]['task']['id']).project == 'foo'
+        assert Task.query.get(keep_id).complete
+        assert Task.query.get(drop_id) is None
+        assert Task.query.filter_by(name='bad date').first() is None
+        assert Task.query.count() == 2
+
+        # Bodies that are not objects are rejected whole
+        for url in ('/tasks/batch', '/tasks/create', '/tasks/update/{}'.format(keep_id)):
+            assert self.app.post('/viortio/api/v1.0' + url, json=[operations[0]], headers=headers).status_code == 400
+        assert self.app.post('/viortio/api/v1.0/tasks/create', json={'name': 'x', 'complete': 1},
+                             headers=headers).status_code == 400
+
+    def test_hot_queries_use_indexes(self):
+        u = User(nickname='Jane')
+        db.session.add(u)
+        db.session.commit()
+
+        cursor = encode_cursor(datetime.utcnow(), 1)
+        queries = [u.tasklist_query().order_by(Task.start_date, Task.id),
+                   u.completed_tasks_query().order_by(Task.start_date.desc(), Task.id.desc()),
+                   u.project_tasks_query('foo').order_by(Task.start_date, Task.id),
+                   u.projects_query(),
+                   u.agenda_query(datetime.utcnow(), datetime.utcnow() + timedelta(days=7))
+                       .order_by(Task.due_date, Task.id),
+                   u.archived_tasks_query().order_by(ArchivedTask.start_date.desc(), ArchivedTask.id.desc()),
+                   keyset_query(u.tasklist_query(), Task.start_date, Task.id, cursor),
+                   keyset_query(u.completed_tasks_query(), Task.start_date, Task.id, cursor, descending=True)]
+
+        for query in queries:
+            plan = self.query_plan(query)
+            assert not [step for step in plan if step.startswith('SCAN')], plan
+            assert not [step for step in plan if 'TEMP B-TREE' in step], plan
+
+    def test_upgrade_schema_creates_missing_indexes(self):
+        db.session.execute('DROP INDEX ix_task_user_project')
+        db.session.commit()
+        upgrade_schema()
+        names = [row[0] for row in db.session.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        assert 'ix_task_user_project' in names
+
+    def test_upgrade_schema_adds_autoincrement(self):
+        u = User(nickname='Jane')
+        db.session.add(u)
+        db.session.commit()
+        with db.engine.begin() as connection:
+            sql = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'task'").scalar()
+            connection.exec_driver_sql('DROP TABLE task')
+            connection.exec_driver_sql(sql.replace('AUTOINCREMENT', ''))
+        db.session.add_all([Task(name='Buy milk', user_id=u.id), Task(name='Walk dog', user_id=u.id)])
+        db.session.add(ArchivedTask(id=10, name='Old', user_id=u.id))
+        db.session.commit()
+
+        upgrade_schema()
+        sql = db.session.execute("SELECT sql FROM sqlite_master WHERE name = 'task'").scalar()
+        assert 'AUTOINCREMENT' in sql
+        assert sorted(t.name for t in Task.query) == ['Buy milk', 'Walk dog']
+        t = Task(name='Buy bread', user_id=u.id)
+        db.session.add(t)
+        db.session.commit()
+        assert t.id == 11
+        assert [t.name for t in search_tasks(u.id, 'bu')] == ['Buy milk', 'Buy bread']
+        plan = self.query_plan(u.tasklist_query().order_by(Task.start_date, Task.id))
+        assert not [step for step in plan if step.startswith('SCAN')], plan
+
+    def test_upgrade_schema_moves_user_versions(self):
+        db.session.add_all([User(nickname='Jane'), User(nickname='John')])
+        db.session.commit()
+        db.session.execute('ALTER TABLE user ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+        db.session.execute('ALTER TABLE user ADD COLUMN data_modified DATETIME')
+        db.session.execute("UPDATE user SET data_version = 7 WHERE nickname = 'Jane'")
+        db.session.commit()
+        upgrade_schema()
+        upgrade_schema()
+        jane = User.query.filter_by(nickname='Jane').one()
+        assert [(v.user_id, v.data_version) for v in UserVersion.query.order_by(UserVersion.user_id)] == \
+            [(jane.id, 7), (jane.id + 1, 0)]
 
+    def test_sqlite_pragmas(self):
+        pragmas = {name: db.session.execute('PRAGMA {}'.format(name)).scalar() for name in self.flask_app.config['SQLITE_PRAGMAS']}
+        assert pragmas['journal_mode'] == 'wal'
+        assert pragmas['synchronous'] == 1
+        assert pragmas['busy_timeout'] == 5000
+        assert pragmas['cache_size'] == -16000
+
+    def test_engine_options(self):
+        sqlite = engine_options('sqlite:////tmp/viortio.db', self.flask_app.config)
+        assert sqlite['pool_size'] == self.flask_app.config['DATABASE_POOL_SIZE']
+        assert sqlite['connect_args'] == {'check_same_thread': False}
+        assert engine_options('sqlite://', self.flask_app.config) == {}
+
+        postgres = engine_options('postgresql://viortio@localhost/viortio', self.flask_app.config)
+        assert postgres['pool_pre_ping']
+        assert postgres['pool_recycle'] == self.flask_app.config['DATABASE_POOL_RECYCLE']
+        assert 'poolclass' not in postgres
+
+    def test_project_summaries(self):
+        u = User(nickname='Jane')
+        db.session.add(u)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        soon = Task(name='soon', user_id=u.id, start_date=now, due_date=now + timedelta(days=1), project='foo')
+        later = Task(name='later', user_id=u.id, start_date=now, due_date=now + timedelta(days=5), project='foo')
+        other = Task(name='other', user_id=u.id, start_date=now, project='bar')
+        db.session.add_all([soon, later, other])
+        db.session.commit()
+
+        def summary(name):
+            p = Project.query.filter_by(user_id=u.id, name=name).first()
+            return p and (p.open_count, p.completed_count, p.next_due_date)
+
+        assert summary('foo') == (2, 0, soon.due_date)
+        assert summary('bar') == (1, 0, None)
+
+        soon.complete = True
+        db.session.commit()
+        assert summary('foo') == (1, 1, later.due_date)
+
+        later.project = 'bar'
+        db.session.commit()
+        assert summary('foo') == (0, 1, None)
+        assert summary('bar') == (2, 0, later.due_date)
+
+        db.session.delete(soon)
+        db.session.commit()
+        assert summary('foo') is None
+        assert [p[0] for p in u.get_projects()] == ['bar']
+
+        db.session.execute('DELETE FROM project')
+        db.session.commit()
+        rebuild_projects()
+        assert summary('bar') == (2, 0, later.due_date)
+
+    def test_api_conditional_requests(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(Task(name='done', user_id=u.id, start_date=datetime.utcnow(), complete=True, project='foo'))
+        db.session.commit()
+
+        headers = self.api_headers('Jane', '12345')
+        for url in ('/viortio/api/v1.0/tasks/completed', '/viortio/api/v1.0/projects', '/viortio/api/v1.0/projects/foo'):
+            rv = self.app.get(url, headers=headers)
+            etag, modified = rv.headers['ETag'], rv.headers['Last-Modified']
+            rv = self.app.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            assert rv.status_code == 304
+            assert rv.data == b''
+            rv = self.app.get(url, headers=dict(headers, **{'If-Modified-Since': modified}))
+            assert rv.status_code == 304
+
+        rv = self.app.get('/viortio/api/v1.0/projects', headers=headers)
+        etag = rv.headers['ETag']
+        self.app.post('/viortio/api/v1.0/tasks/create', json={'name': 'new', 'project': 'bar'}, headers=headers)
+        rv = self.app.get('/viortio/api/v1.0/projects', headers=dict(headers, **{'If-None-Match': etag}))
+        assert rv.status_code == 200
+        assert 'bar' in rv.get_json()['projects']
+
+    def test_api_conditional_tasklist_follows_start_dates(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(Task(name='future', user_id=u.id, start_date=datetime.utcnow() + timedelta(days=1)))
+        db.session.commit()
+
+        headers = self.api_headers('Jane', '12345')
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+        assert rv.get_json()['tasks'] == []
+        etag = rv.headers['ETag']
+        assert self.app.get('/viortio/api/v1.0/tasks', headers=dict(headers, **{'If-None-Match': etag})).status_code == 304
+
+        # Time passing rather than an edit makes the task visible; bypass the ORM so no version is bumped
+        db.session.execute(Task.__table__.update().values(start_date=datetime.utcnow() - timedelta(minutes=1)))
+        db.session.commit()
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=dict(headers, **{'If-None-Match': etag}))
+        assert rv.status_code == 200
+        assert len(rv.get_json()['tasks']) == 1
+
+    def test_api_sync(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        headers = self.api_headers('Jane', '12345')
+
+        rv = self.app.get('/viortio/api/v1.0/sync', headers=headers)
+        assert rv.get_json() == {'changes': [], 'cursor': 0, 'more': False}
+
+        ids = [self.app.post('/viortio/api/v1.0/tasks/create?format=v2', json={'name': name}, headers=headers)
+               .get_json()['id'] for name in ('a', 'b', 'c')]
+        rv = self.app.get('/viortio/api/v1.0/sync?since=0&limit=2&format=v2', headers=headers)
+        page = rv.get_json()
+        assert [c['task']['name'] for c in page['changes']] == ['a', 'b']
+        assert page['more']
+        rv = self.app.get('/viortio/api/v1.0/sync?format=v2&since={}'.format(page['cursor']), headers=headers)
+        cursor = rv.get_json()['cursor']
+        assert [c['task']['name'] for c in rv.get_json()['changes']] == ['c']
+
+        self.app.post('/viortio/api/v1.0/tasks/update/{}'.format(ids[0]), json={'complete': True}, headers=headers)
+        self.app.post('/viortio/api/v1.0/tasks/update/{}'.format(ids[1]), json={'name': 'b2'}, headers=headers)
+        self.app.post('/viortio/api/v1.0/tasks/update/{}'.format(ids[1]), json={'name': 'b3'}, headers=headers)
+        self.app.post('/viortio/api/v1.0/tasks/delete/{}'.format(ids[2]), headers=headers)
+
+        rv = self.app.get('/viortio/api/v1.0/sync?format=v2&since={}'.format(cursor), headers=headers)
+        changes = rv.get_json()['changes']
+        assert [c['op'] for c in changes] == ['complete', 'update', 'delete']
+        assert changes[0]['task']['complete'] is True
+        assert changes[1]['task']['name'] == 'b3'
+        assert changes[2] == {'op': 'delete', 'id': ids[2]}
+
+    def test_api_event_stream(self):
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        headers = self.api_headers('Jane', '12345')
+
+        for name in ('a', 'b'):
+            self.app.post('/viortio/api/v1.0/tasks/create', json={'name': name}, headers=headers)
+        timeout = self.flask_app.config['PUSH_STREAM_TIMEOUT']
+        self.flask_app.config['PUSH_STREAM_TIMEOUT'] = 0.1
+        try:
+            rv = self.app.get('/viortio/api/v1.0/events?format=v2', headers=dict(headers, **{'Last-Event-ID': '0'}))
+        finally:
+            self.flask_app.config['PUSH_STREAM_TIMEOUT'] = timeout
+        assert rv.mimetype == 'text/event-stream'
+
+        events = [block for block in rv.get_data(as_text=True).split('\n\n') if block.startswith('id:')]
+        assert len(events) == 2
+        change_id, kind, data = events[1].split('\n')
+        assert change_id == 'id: 2'
+        assert kind == 'event: task'
+        assert json.loads(data[len('data: '):])['task']['name'] == 'b'
+
+    def test_push_brokers(self):
+        u = User(nickname='Jane')
+        db.session.add(u)
+        db.session.commit()
+
+        broker = get_broker()
+        assert not broker.wait(u.id, 0, 0.01)
+        db.session.add(Task(name='a', user_id=u.id, start_date=datetime.utcnow()))
+        db.session.commit()
+        latest = TaskChange.query.filter_by(user_id=u.id).count()
+        assert broker.wait(u.id, 0, 0.01)
+        assert not broker.wait(u.id, latest, 0.01)
+
+        broker = DatabaseBroker(self.flask_app)
+        assert broker.wait(u.id, 0, 0.01)
+        assert not broker.wait(u.id, latest, 0.01)
+
+    def test_search(self):
+        jane = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        john = User(nickname='John')
+        db.session.add_all([jane, john])
+        db.session.commit()
+
+        now = datetime.utcnow()
+        milk = Task(name='Buy milk', user_id=jane.id, start_date=now)
+        groceries = Task(name='Buy groceries and milk for the party', user_id=jane.id, start_date=now)
+        db.session.add_all([milk, groceries, Task(name='Buy milk', user_id=john.id, start_date=now)])
+        db.session.commit()
+
+        assert [t.name for t in search_tasks(jane.id, 'mil')] == ['Buy milk', 'Buy groceries and milk for the party']
+        assert [t.name for t in search_tasks(jane.id, 'buy GROC')] == ['Buy groceries and milk for the party']
+        assert search_tasks(jane.id, '"*') == []
+
+        milk.name = 'Pick up dry cleaning'
+        db.session.commit()
+        assert [t.name for t in search_tasks(jane.id, 'clean')] == ['Pick up dry cleaning']
+        db.session.delete(groceries)
+        db.session.commit()
+        assert search_tasks(jane.id, 'milk') == []
+
+        rv = self.app.get('/viortio/api/v1.0/search?q=dry&format=v2', headers=self.api_headers('Jane', '12345'))
+        assert [t['name'] for t in rv.get_json()['tasks']] == ['Pick up dry cleaning']
+
+        self.login('Jane', '12345')
+        rv = self.app.get('/search?q=dry')
+        assert b'Pick up dry cleaning' in rv.data
+
+        rv = self.app.get('/viortio/api/v1.0/search?q=dry&limit=-1', headers=self.api_headers('Jane', '12345'))
+        assert len(rv.get_json()['tasks']) == 1
+
+        # Without FTS5, LIKE metacharacters in the query match only themselves
+        db.session.add_all([Task(name='snake_case', user_id=jane.id, start_date=now),
+                            Task(name='snakeXcase', user_id=jane.id, start_date=now)])
+        db.session.commit()
+        key = str(db.engine.url)
+        search._fts5_available[key] = False
+        try:
+            assert [t.name for t in search_tasks(jane.id, 'e_c')] == ['snake_case']
+            assert [t.name for t in search_tasks(jane.id, 'clean')] == ['Pick up dry cleaning']
+        finally:
+            del search._fts5_available[key]
+
+    def test_profiling(self):
+        admin = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(admin)
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
 
+        self.flask_app.config.update(PROFILING=True, PROFILING_QUERY_THRESHOLD=1, ADMIN_USERS=['admin'])
+        rv = self.app.get('/viortio/api/v1.0/tasks', headers=headers)
+        assert 'sql;dur=' in rv.headers['Server-Timing']
+        assert 'password_hash;dur=' in rv.headers['Server-Timing']
+        assert int(rv.headers['X-Query-Count']) >= 2
 
+        self.login('admin', '12345')
+        self.app.get('/index')
+        rv = self.app.get('/admin/metrics', headers=headers)
+        self.flask_app.config.update(PROFILING=False, ADMIN_USERS=[])
 
+        endpoints = rv.get_json()['endpoints']
+        assert endpoints['api.get_tasks']['requests'] == 1
+        assert endpoints['api.get_tasks']['flagged'] == 1
+        assert endpoints['web.index']['timings_ms']['render'] > 0
+        assert sum(endpoints['web.index']['wall_ms']['buckets'].values()) == endpoints['web.index']['requests']
 
+        rv = self.app.get('/admin/metrics', headers=headers)
+        assert rv.status_code == 403
+
+    def test_fragment_cache(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        self.login('admin', '12345')
+        self.add_task('Write tests', '', '', 'work')
+        cache = get_fragment_cache()
+        cache.clear()
+
+        rv = self.app.get('/index')
+        assert b'Write tests' in rv.data and b'1 open' in rv.data
+        hits = cache.hits
+        rv = self.app.get('/index')
+        assert b'Write tests' in rv.data
+        assert cache.hits == hits + 2
+        self.project_page('work')
+        assert b'Write tests' in self.project_page('work').data
+
+        # Completing the task bumps the user's version, so no page serves the cached fragments
+        task = Task.query.filter_by(name='Write tests').first()
+        rv = self.app.post('/index', data={'is_finished': task.id})
+        assert b'Write tests' not in rv.data
+        assert b'Write tests' not in self.project_page('work').data
+        assert b'Write tests' in self.app.get('/completed').data
+
+        # Changes committed elsewhere, such as by a job worker, are not served stale either
+        self.app.get('/index')
+        with db.engine.begin() as connection:
+            connection.execute(Task.__table__.insert().values(name='Archive logs', user_id=u.id,
+                                                              start_date=datetime.utcnow(), complete=False))
+            connection.execute(UserVersion.__table__.update().where(UserVersion.user_id == u.id)
+                               .values(data_version=UserVersion.data_version + 1))
+        assert b'Archive logs' in self.app.get('/index').data
+
+    def test_filesystem_cache(self):
+        now = [1000.0]
+        cache = FileSystemCache(tempfile.mkdtemp(), maxsize=2, ttl=10, timer=lambda: now[0])
+        cache.set('a', u'<li>\u00e9</li>')
+        assert cache.get('a') == u'<li>\u00e9</li>'
+        assert cache.get('b') is None
+        cache.set('b', 'b')
+        os.utime(cache.path('a'), (0, 0))
+        cache.set('c', 'c')
+        assert cache.get('a') is None and len(cache) == 2
+        now[0] += 11
+        assert cache.get('b') is None
+        assert cache.stats()['hits'] == 1
+
+    def test_archive(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        for i in range(4):
+            db.session.add(Task(name='old {}'.format(i), user_id=u.id, start_date=now - timedelta(days=100 + i),
+                                project='work', complete=True))
+        db.session.add(Task(name='recent', user_id=u.id, start_date=now - timedelta(days=1), project='work',
+                            complete=True))
+        db.session.add(Task(name='open', user_id=u.id, start_date=now, project='work'))
+        db.session.add(Task(name='old home', user_id=u.id, start_date=now - timedelta(days=100), project='home',
+                            complete=True))
+        db.session.commit()
+        old = Task.query.filter(Task.name.like('old%')).all()
+        for t in old:
+            t.completed_at = now - timedelta(days=60)
+        db.session.commit()
+        old_id = old[0].id
+        headers = self.api_headers('admin', '12345')
+        before = self.app.get('/viortio/api/v1.0/tasks/completed', headers=headers).get_json()['completed']
+        sync = self.app.get('/viortio/api/v1.0/sync', headers=headers).get_json()['changes']
+
+        projects = self.app.get('/viortio/api/v1.0/projects', headers=headers).get_json()
+
+        # Batches seek past the previous batch instead of scanning the open tasks before it again
+        plan = self.query_plan(archivable_query(now, after=old_id).limit(2))
+        assert [step for step in plan if 'INTEGER PRIMARY KEY (rowid>?)' in step], plan
+        self.flask_app.config['ARCHIVE_BATCH_SIZE'] = 2
+        assert archive_tasks(days=30) == 5
+        assert Task.query.count() == 2 and ArchivedTask.query.count() == 5
+
+        # Project summaries keep counting archived tasks, even once a project has no live tasks left
+        assert self.app.get('/viortio/api/v1.0/projects', headers=headers).get_json() == projects
+        assert Project.query.filter_by(name='work').one().completed_count == 5
+        assert Project.query.filter_by(name='home').one().completed_count == 1
+        rebuild_projects()
+        assert Project.query.filter_by(name='work').one().completed_count == 5
+        assert Project.query.filter_by(name='home').one().completed_count == 1
+
+        # Reads merge the archive back in, in the same order and across page boundaries
+        assert self.app.get('/viortio/api/v1.0/tasks/completed', headers=headers).get_json()['completed'] == before
+        page = self.app.get('/viortio/api/v1.0/tasks/completed?limit=3', headers=headers).get_json()
+        rest = self.app.get('/viortio/api/v1.0/tasks/completed?cursor=' + page['next_cursor'], headers=headers)
+        assert page['completed'] + rest.get_json()['completed'] == before
+        assert self.app.get('/viortio/api/v1.0/sync', headers=headers).get_json()['changes'] == sync
+        self.login('admin', '12345')
+        assert b'old 3' in self.app.get('/completed').data
+
+        rv = self.app.post('/viortio/api/v1.0/tasks/restore/{}'.format(old_id), headers=headers)
+        assert rv.status_code == 201
+        assert Task.query.get(old_id).name == 'old 0'
+        assert Project.query.filter_by(name='work').one().completed_count == 5
+        assert self.app.post('/viortio/api/v1.0/tasks/restore/{}'.format(old_id), headers=headers).status_code == 404
+
+        # The newest task can be archived too; its id is never handed out again
+        newest = Task.query.filter_by(name='open').one()
+        newest.complete = True
+        newest.completed_at = now - timedelta(days=60)
+        db.session.commit()
+        newest_id = newest.id
+        assert archive_tasks(days=30) == 1 and Task.query.get(newest_id) is None
+        t = Task(name='new', user_id=u.id, start_date=now)
+        db.session.add(t)
+        db.session.commit()
+        assert t.id > newest_id
+        assert self.app.post('/viortio/api/v1.0/tasks/restore/{}'.format(newest_id), headers=headers).status_code == 201
+
+    def test_api_dates_with_time_zones(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+        create = lambda payload: self.app.post('/viortio/api/v1.0/tasks/create?format=v2', json=payload,
+                                               headers=headers)
+        assert create({'name': 'a', 'project': 'p', 'due_date': '2029-01-02 00:00:00'}).status_code == 201
+
+        # Dates given with a zone are stored as naive UTC, so they compare with those given without one
+        rv = create({'name': 'b', 'project': 'p', 'due_date': '2029-01-01T00:00:00Z'})
+        assert rv.status_code == 201 and rv.get_json()['due_date'] == '2029-01-01 00:00:00'
+        assert Project.query.one().next_due_date == datetime(2029, 1, 1)
+        rv = create({'name': 'c', 'complete': True, 'recurrence': 'FREQ=DAILY',
+                     'start_date': '2029-01-01T05:00:00+05:00'})
+        assert rv.status_code == 201 and rv.get_json()['start_date'] == '2029-01-01 00:00:00'
+        assert Task.query.get(rv.get_json()['id']).next_occurrence == datetime(2029, 1, 2)
+
+        operations = [{'op': 'create', 'name': 'd', 'due_date': '2029-01-01T05:00:00+05:00'}]
+        rv = self.app.post('/viortio/api/v1.0/tasks/batch?format=v2', json={'operations': operations},
+                           headers=headers)
+        assert rv.get_json()['results'][0]['task']['due_date'] == '2029-01-01 00:00:00'
+
+    def test_recurring_tasks(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+        start = datetime.utcnow().replace(microsecond=0) - timedelta(hours=1)
+        payload = {'name': 'Water plants', 'start_date': str(start), 'due_date': str(start + timedelta(hours=2)),
+                   'recurrence': 'FREQ=DAILY;INTERVAL=2'}
+        assert self.app.post('/viortio/api/v1.0/tasks/create', json=dict(payload, recurrence='FREQ=SOMETIMES'),
+                             headers=headers).status_code == 400
+        task = self.app.post('/viortio/api/v1.0/tasks/create?format=v2', json=payload, headers=headers).get_json()
+        assert task['recurrence'] == 'FREQ=DAILY;INTERVAL=2'
+
+        # Completing it schedules the next occurrence without creating it
+        self.app.post('/viortio/api/v1.0/tasks/update/{}'.format(task['id']), json={'complete': True}, headers=headers)
+        assert Task.query.count() == 1
+        assert Task.query.get(task['id']).next_occurrence == start + timedelta(days=2)
+        assert materialize_occurrences(u.id) == 0
+
+        assert materialize_occurrences(u.id, now=start + timedelta(days=2)) == 1
+        done, upcoming = Task.query.order_by(Task.id).all()
+        assert done.recurrence is None and done.next_occurrence is None
+        assert upcoming.recurrence == 'FREQ=DAILY;INTERVAL=2' and not upcoming.complete
+        assert upcoming.start_date == start + timedelta(days=2)
+        assert upcoming.due_date == start + timedelta(days=2, hours=2)
+
+        # Views materialize occurrences whose start has arrived before listing tasks, even on revalidation
+        upcoming.complete = True
+        db.session.commit()
+        url = '/viortio/api/v1.0/tasks?format=v2'
+        etag = self.app.get(url, headers=headers).headers['ETag']
+        assert self.app.get(url, headers=dict(headers, **{'If-None-Match': etag})).status_code == 304
+        Task.query.get(upcoming.id).next_occurrence = datetime.utcnow() - timedelta(minutes=1)
+        db.session.commit()
+        rv = self.app.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+        assert rv.status_code == 200 and [t['name'] for t in rv.get_json()['tasks']] == ['Water plants']
+        assert self.app.get(url, headers=dict(headers, **{'If-None-Match': rv.headers['ETag']})).status_code == 304
+
+        # The v1 payload keeps the fields it had before recurrence was added
+        task = json.loads(self.app.get('/viortio/api/v1.0/tasks', headers=headers).get_json()['tasks'][0])
+        assert 'recurrence' not in task and set(task) == set(Task.V1_FIELDS)
+        assert self.app.get('/viortio/api/v1.0/tasks?fields=recurrence', headers=headers).status_code == 400
+
+    def test_agenda(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        today = datetime(now.year, now.month, now.day)
+        for name, due in (('late', now - timedelta(days=2)), ('today', today + timedelta(hours=23)),
+                          ('friday', today + timedelta(days=4)), ('later', today + timedelta(days=30)), ('undated', None)):
+            db.session.add(Task(name=name, user_id=u.id, start_date=now, due_date=due))
+        db.session.add(Task(name='done', user_id=u.id, start_date=now, due_date=today, complete=True))
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+
+        def names(url):
+            return [t['name'] for t in self.app.get(url + '?format=v2', headers=headers).get_json()['tasks']]
+
+        assert names('/viortio/api/v1.0/agenda/overdue') == ['late']
+        assert names('/viortio/api/v1.0/agenda/today') == ['today']
+        assert names('/viortio/api/v1.0/agenda/week') == ['today', 'friday']
+        rv = self.app.get('/viortio/api/v1.0/agenda?start={}&end={}'.format(today.date(), today + timedelta(days=60)),
+                          headers=headers)
+        assert [json.loads(t)['name'] for t in rv.get_json()['tasks']] == ['today', 'friday', 'later']
+        assert self.app.get('/viortio/api/v1.0/agenda?start=soon', headers=headers).status_code == 400
+        assert self.app.get('/viortio/api/v1.0/agenda/month', headers=headers).status_code == 404
+        plan = ' '.join(self.query_plan(u.agenda_query(today, today + timedelta(days=7))))
+        assert 'ix_task_user_complete_due' in plan and 'due_date>' in plan
+
+    def test_calendar_feed(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        due = datetime(2030, 1, 15)
+        db.session.add(Task(name='Pay rent, on time', user_id=u.id, start_date=due, due_date=due, project='home'))
+        db.session.add(Task(name='Call dentist', user_id=u.id, start_date=due, due_date=due.replace(hour=9)))
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+
+        url = self.app.get('/viortio/api/v1.0/calendar', headers=headers).get_json()['url']
+        token = self.app.get('/viortio/api/v1.0/token', headers=headers).get_json()['token']
+        assert self.app.get('/viortio/api/v1.0/calendar', headers=self.api_headers(token, '')).status_code == 403
+        assert self.app.get('/calendar/forged.ics').status_code == 404
+
+        rv = self.app.get(url)
+        assert rv.mimetype == 'text/calendar'
+        feed = rv.get_data(as_text=True)
+        assert 'SUMMARY:Pay rent\\, on time\r\nCATEGORIES:home' in feed
+        assert 'DTSTART;VALUE=DATE:20300115' in feed and 'DTSTART:20300115T090000Z' in feed
+        assert self.app.get(url, headers={'If-None-Match': rv.headers['ETag']}).status_code == 304
+
+        # Only the changed task is re-rendered; the others are reused from the cached feed
+        rent = get_feed_cache().get(u.id)[1]
+        Task.query.filter_by(name='Call dentist').one().complete = True
+        db.session.add(Task(name='Renew passport', user_id=u.id, start_date=due, due_date=due))
+        db.session.commit()
+        rv = self.app.get(url, headers={'If-None-Match': rv.headers['ETag']})
+        assert rv.status_code == 200
+        feed = rv.get_data(as_text=True)
+        assert 'Call dentist' not in feed and 'Renew passport' in feed
+        events = get_feed_cache().get(u.id)[1]
+        rent_id = Task.query.filter_by(project='home').one().id
+        assert events[rent_id] is rent[rent_id]
+
+        # A reset or a password change revokes the URL, and a deleted user's URL is not found
+        rv = self.app.post('/viortio/api/v1.0/calendar', headers=headers)
+        assert rv.status_code == 201 and self.app.get(url).status_code == 404
+        url = rv.get_json()['url']
+        assert self.app.get('/viortio/api/v1.0/calendar', headers=headers).get_json()['url'] == url
+        assert self.app.get(url).status_code == 200
+        User.query.get(u.id).password_hash = generate_password_hash('54321')
+        db.session.commit()
+        assert self.app.get(url).status_code == 404
+        url = self.app.get('/viortio/api/v1.0/calendar', headers=self.api_headers('admin', '54321')).get_json()['url']
+        assert self.app.get(url).status_code == 200
+        Task.query.delete()
+        User.query.filter_by(id=u.id).delete()
+        db.session.commit()
+        assert self.app.get(url).status_code == 404
+
+    def test_jobs(self):
+        calls = []
+
+        @job('flaky')
+        def flaky(n):
+            calls.append(n)
+            if len(calls) < 2:
+                raise RuntimeError('try again')
+        self.addCleanup(JOBS.pop, 'flaky', None)
+
+        self.flask_app.config['JOB_RETRY_DELAY'] = 0
+        enqueue('flaky', n=1)
+        db.session.commit()
+        assert work(self.flask_app) == 2
+        j = Job.query.one()
+        assert j.status == 'done' and j.attempts == 2 and 'try again' in j.last_error
+        assert calls == [1, 1]
+
+        calls[:] = []
+        j = enqueue('flaky', n=2, max_attempts=1)
+        db.session.commit()
+        job_id = j.id
+        assert work(self.flask_app) == 1
+        assert db.session.get(Job, job_id).status == 'failed'
+
+        # A job whose worker died is picked up again once it times out
+        j = enqueue('flaky', n=3)
+        db.session.commit()
+        assert claim('dead-worker').id == j.id
+        assert claim('other-worker') is None
+        assert requeue_stale() == 0
+        self.flask_app.config['JOB_TIMEOUT'] = -1
+        assert requeue_stale() == 1
+        assert run_job(claim('other-worker'))
+        self.flask_app.config['JOB_TIMEOUT'] = 600
+        self.flask_app.config['JOB_RETRY_DELAY'] = 30
+
+    def test_archive_job(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        db.session.add(Task(name='old', user_id=u.id, start_date=now - timedelta(days=400), complete=True,
+                            completed_at=now - timedelta(days=400)))
+        db.session.add(Task(name='open', user_id=u.id, start_date=now))
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+
+        rv = self.app.post('/viortio/api/v1.0/tasks/archive', json={'days': 30}, headers=headers)
+        assert rv.status_code == 202
+        url = '/viortio/api/v1.0/jobs/{}'.format(rv.get_json()['job']['id'])
+        assert self.app.get(url, headers=headers).get_json()['job']['status'] == 'queued'
+        assert ArchivedTask.query.count() == 0
+        assert work(self.flask_app) == 1
+        assert self.app.get(url, headers=headers).get_json()['job']['status'] == 'done'
+        assert [t.name for t in ArchivedTask.query] == ['old']
+
+    def test_identity_cache(self):
+        from sqlalchemy import event
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        self.login('admin', '12345')
+        self.add_task('Write tests', '', '', 'work')
+        self.app.get('/index')
+
+        def user_statements(path):
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                # In a context of its own, so flask_login loads the user as it does on a real request
+                with self.flask_app.app_context():
+                    assert b'Write tests' in self.app.get(path).data
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            return [s for s in statements if 'FROM user' in s or 'user_version' in s]
+
+        # The user row comes from the snapshot, and the version is read once for all of a page's fragments
+        user_statements('/index')
+        for path in ('/index', '/project/work'):
+            statements = user_statements(path)
+            assert len(statements) == 1 and 'user_version' in statements[0], statements
+
+        # A shared identity cache is kept current by every process, so its snapshot's version is used
+        self.flask_app.config.update(IDENTITY_CACHE_BACKEND='filesystem', IDENTITY_CACHE_DIR=tempfile.mkdtemp())
+        del self.flask_app.extensions['identity_cache']
+        user_statements('/index')
+        assert user_statements('/index') == [] and user_statements('/project/work') == []
+        self.add_task('Write docs', '', '', 'work')
+        with self.flask_app.app_context():
+            assert b'Write docs' in self.project_page('work').data
+        self.flask_app.config['IDENTITY_CACHE_BACKEND'] = 'memory'
+        del self.flask_app.extensions['identity_cache']
+
+        # Changes to the user, and to their tasks, drop the cached snapshot
+        version = get_identity_cache().load(u.id).data_version
+        User.query.get(u.id).nickname = 'root'
+        db.session.commit()
+        assert get_identity_cache().get(u.id) is None
+        assert get_identity_cache().load(u.id).nickname == 'root'
+        self.app.post('/index', data={'is_finished': Task.query.filter_by(name='Write tests').one().id})
+        assert get_identity_cache().load(u.id).data_version == version + 1
+
+        snapshot = get_identity_cache().load(u.id)
+        assert UserSnapshot.from_json(snapshot.to_json()) == snapshot
+        assert snapshot.get_id() == str(u.id) and [t.name for t in snapshot.get_tasklist()] == ['Write docs']
+
+        # A snapshot read while an invalidation comes in is not kept, as it may predate the change
+        cache = get_identity_cache()
+        cache.invalidate([u.id])
+        get = db.session.get
+        with mock.patch.object(db.session, 'get', lambda *args: cache.invalidate([u.id]) or get(*args)):
+            assert cache.load(u.id).nickname == 'root'
+        assert cache.get(u.id) is None
+        assert cache.load(u.id) == cache.get(u.id) == snapshot
+
+    def test_benchmark(self):
+        nicknames = benchmark.seed(users=2, tasks=20, projects=3, completed_ratio=0.5, rng=random.Random(0))
+        assert Task.query.count() == 40
+        assert Project.query.count() > 0
+
+        results = benchmark.run(benchmark.TestClient(self.flask_app), nicknames[0], requests=2)
+        assert results['api.tasks']['requests'] == 2
+        assert results['web.index']['p99_ms'] >= results['web.index']['p50_ms']
+
+        report = {'endpoints': results}
+        slower = {'endpoints': {'api.tasks': dict(results['api.tasks'], p95_ms=results['api.tasks']['p95_ms'] / 10)}}
+        assert benchmark.compare(report, report, 0.2) == []
+        assert len(benchmark.compare(report, slower, 0.2)) == 1
+
+    def test_create_app(self):
+        other = create_app(TESTING=True, SQLALCHEMY_DATABASE_URI='sqlite://', CREDENTIAL_CACHE_SIZE=1)
+        assert other.config['CREDENTIAL_CACHE_SIZE'] == 1
+        assert self.flask_app.config['CREDENTIAL_CACHE_SIZE'] != 1
+        assert other.jinja_env.bytecode_cache is not None
+        with other.app_context():
+            other_cache = get_credential_cache()
+        assert other_cache is not get_credential_cache()
+        assert other.url_map.bind('localhost').match('/viortio/api/v1.0/tasks')[0] == 'api.get_tasks'
+
+        with self.assertRaises(RuntimeError):
+            create_app(SECRET_KEY=None)
+        with self.assertRaises(RuntimeError):
+            create_app(SHARDS={'a': 'sqlite://'}, IDENTITY_CACHE_BACKEND='memory')
+
+        timings = benchmark.startup(runs=1)
+        assert set(timings) == {'import_ms', 'create_app_ms', 'first_request_ms'}
+
+    def test_static_assets(self):
+        rv = self.app.get('/login')
+        assert b'/static/css/bootstrap.css' in rv.data
+
+        directory = tempfile.mkdtemp()
+        self.flask_app.config['ASSETS_DIR'] = directory
+        manifest = build_assets(self.flask_app.static_folder, directory)
+        hashed = manifest['css/bootstrap.css']
+        assert hashed != 'css/bootstrap.css' and hashed.startswith('css/bootstrap.')
+        assert build_assets(self.flask_app.static_folder, directory) == manifest
+
+        # The manifest is read once per app, so drop it as a restart would
+        self.flask_app.extensions.pop('assets')
+        rv = self.app.get('/login')
+        assert '/assets/{}'.format(hashed).encode() in rv.data
+
+        with open(os.path.join(self.flask_app.static_folder, 'css', 'bootstrap.css'), 'rb') as f:
+            original = f.read()
+        rv = self.app.get('/assets/' + hashed)
+        assert rv.get_data() == original and 'Content-Encoding' not in rv.headers
+        assert 'immutable' in rv.headers['Cache-Control'] and rv.cache_control.max_age == 365 * 24 * 3600
+        assert rv.mimetype == 'text/css' and 'Accept-Encoding' in rv.vary
+        rv.close()
+        rv = self.app.get('/assets/' + hashed, headers={'Accept-Encoding': 'gzip, deflate'})
+        assert rv.headers['Content-Encoding'] == 'gzip' and gzip.decompress(rv.get_data()) == original
+        rv.close()
+        assert self.app.get('/assets/manifest.json').status_code == 404
+        assert self.app.get('/assets/../config.py').status_code == 404
+
+    def test_compression(self):
+        u = User(nickname='admin', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        for i in range(50):
+            db.session.add(Task(name='Task number {}'.format(i), user_id=u.id, start_date=datetime.utcnow()))
+        db.session.commit()
+        headers = self.api_headers('admin', '12345')
+        url = '/viortio/api/v1.0/tasks?format=v2'
+
+        plain = self.app.get(url, headers=headers)
+        assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.vary
+        rv = self.app.get(url, headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(rv.get_data()) == plain.get_data()
+        assert rv.headers['ETag'] == 'W/' + plain.headers['ETag']
+        assert self.app.get(url, headers=dict(headers, **{'If-None-Match': rv.headers['ETag']})).status_code == 304
+
+        # Small responses and refused encodings go out as they are
+        assert 'Content-Encoding' not in self.app.get('/viortio/api/v1.0/projects', headers=dict(
+            headers, **{'Accept-Encoding': 'gzip'})).headers
+        assert 'Content-Encoding' not in self.app.get(url, headers=dict(
+            headers, **{'Accept-Encoding': 'gzip;q=0'})).headers
+
+    def test_sharding(self):
+        assert plan_rebalance({None: {1: 5}, 'a': {2: 10, 3: 1}, 'b': {}}) == [(1, None, 'b'), (3, 'a', 'b')]
+        assert plan_rebalance({None: {1: 5}}) == []
+
+        directory = tempfile.mkdtemp()
+        uri = 'sqlite:///' + os.path.join(directory, '{}.db')
+        sharded = create_app(TESTING=True, SQLALCHEMY_DATABASE_URI=uri.format('main'), SHARD_MOVE_GRACE=0,
+                             WTF_CSRF_ENABLED=False, IDENTITY_CACHE_BACKEND='filesystem',
+                             IDENTITY_CACHE_DIR=os.path.join(directory, 'identity'),
+                             SHARDS={'a': uri.format('a'), 'b': uri.format('b')})
+        db.session.remove()
+        with sharded.app_context():
+            from sqlalchemy import event
+            db.create_all()
+            assert provision_shards() == ['a', 'b']
+            client = sharded.test_client()
+
+            def tasks_in(shard):
+                with engine_for(shard).connect() as connection:
+                    return sorted(connection.execute(Task.__table__.select()).mappings().all(), key=lambda t: t['id'])
+
+            # A user from before sharding keeps their tasks in the main database
+            legacy = User(nickname='legacy', password_hash=generate_password_hash('12345'))
+            db.session.add(legacy)
+            db.session.commit()
+            db.session.delete(db.session.get(ShardAssignment, legacy.id))
+            db.session.add(Task(name='Old task', user_id=legacy.id, start_date=datetime.utcnow()))
+            db.session.commit()
+            legacy_id = legacy.id
+
+            assert client.post('/viortio/api/v1.0/register', json={'username': 'Jane', 'password': '12345'}) \
+                .status_code == 201
+            jane = User.query.filter_by(nickname='Jane').one()
+            jane_id = jane.id
+            home = ShardAssignment.query.get(jane_id).shard
+            other = 'a' if home == 'b' else 'b'
+            headers = self.api_headers('Jane', '12345')
+            for name in ('Write report', 'Book flights'):
+                client.post('/viortio/api/v1.0/tasks/create', json={'name': name, 'project': 'work'}, headers=headers)
+            assert [t['name'] for t in tasks_in(home)] == ['Write report', 'Book flights']
+            assert [t['name'] for t in tasks_in(None)] == ['Old task']
+
+            rv = client.get('/viortio/api/v1.0/tasks?format=v2', headers=headers)
+            assert [t['name'] for t in rv.get_json()['tasks']] == ['Write report', 'Book flights']
+            assert client.get('/viortio/api/v1.0/search?q=flig&format=v2', headers=headers).get_json()['tasks']
+            legacy_headers = self.api_headers('legacy', '12345')
+            assert [t['name'] for t in client.get('/viortio/api/v1.0/tasks?format=v2', headers=legacy_headers)
+                    .get_json()['tasks']] == ['Old task']
+
+            # Task writes leave the main database alone: ids come from the shard's block of the sequence, and
+            # the change version is kept next to the tasks
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                task_id = client.post('/viortio/api/v1.0/tasks/create?format=v2', json={'name': 'Call mum'},
+                                      headers=headers).get_json()['id']
+                client.post('/viortio/api/v1.0/tasks/update/{}'.format(task_id), json={'complete': True},
+                            headers=headers)
+                client.post('/viortio/api/v1.0/tasks/delete/{}'.format(task_id), headers=headers)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            assert statements and all(s.lstrip().startswith('SELECT') for s in statements), statements
+            with engine_for(home).connect() as connection:
+                assert connection.execute(UserVersion.__table__.select()).mappings().one()['data_version'] == 5
+
+            # The shard Jane moves to already holds tasks; ids come from disjoint blocks, so none collide
+            john = User(nickname='John', password_hash=generate_password_hash('12345'))
+            db.session.add(john)
+            db.session.commit()
+            john_id = john.id
+            ShardAssignment.query.get(john_id).shard = other
+            db.session.commit()
+            john_headers = self.api_headers('John', '12345')
+            client.post('/viortio/api/v1.0/tasks/create', json={'name': 'Mow lawn'}, headers=john_headers)
+            assert [t['name'] for t in tasks_in(other)] == ['Mow lawn']
+            ids = [t['id'] for t in tasks_in(None) + tasks_in(home) + tasks_in(other)]
+            assert len(set(ids)) == len(ids) == 4
+
+            # Page loads route by the shard kept in the identity snapshot
+            pages = sharded.test_client()
+
+            def page(path):
+                # In a context of its own, so flask_login loads the user as it does on a real request
+                with sharded.app_context():
+                    return pages.get(path)
+
+            with sharded.app_context():
+                pages.post('/login', data=dict(username='Jane', password='12345'))
+            page('/project/work')
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                assert b'Book flights' in page('/project/work').data
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            assert not [s for s in statements if 'shard_assignment' in s]
+
+            # Moving keeps task ids and project summaries; the change log restarts on the new shard
+            before = client.get('/viortio/api/v1.0/tasks?format=v2', headers=headers).get_json()['tasks']
+            db.session.remove()
+            assert move_user(jane_id, other) == 2
+            assert get_identity_cache().get(jane_id) is None
+            assert b'Book flights' in page('/project/work').data
+            assert tasks_in(home) == [] and len(tasks_in(other)) == 3
+            assert [t['name'] for t in client.get('/viortio/api/v1.0/tasks?format=v2', headers=john_headers)
+                    .get_json()['tasks']] == ['Mow lawn']
+            assert client.get('/viortio/api/v1.0/tasks?format=v2', headers=headers).get_json()['tasks'] == before
+            projects = client.get('/viortio/api/v1.0/projects?format=v2', headers=headers).get_json()['projects']
+            assert projects[0]['open_count'] == 2
+            sync = client.get('/viortio/api/v1.0/sync', headers=headers).get_json()['changes']
+            assert [c['op'] for c in sync] == ['create', 'create']
+
+            ShardAssignment.query.get(jane_id).moving = True
+            db.session.commit()
+            rv = client.get('/viortio/api/v1.0/tasks', headers=headers)
+            assert rv.status_code == 503 and 'Retry-After' in rv.headers
+            assert page('/project/work').status_code == 503
+            ShardAssignment.query.get(jane_id).moving = False
+            db.session.commit()
+
+            # Rebalancing first moves users off the main database
+            db.session.remove()
+            loads = shard_loads()
+            assert loads[None] == {legacy_id: 1} and loads[other] == {jane_id: 2, john_id: 1}
+            for user_id, source, target in plan_rebalance(loads):
+                move_user(user_id, target)
+            assert tasks_in(None) == [] and ShardAssignment.query.get(legacy_id).shard == home
+            assert list(each_shard()) == [None, 'a', 'b']
+
+            # Copies left on the target by a failed attempt are replaced, and a source left behind by a failed
+            # last step is cleaned up by purge_strays
+            with engine_for(other).connect() as source, engine_for(home).begin() as target:
+                copy_user(source, target, jane_id)
+            db.session.remove()
+            with mock.patch('app.sharding.purge_user', side_effect=OSError('disk full')):
+                assert move_user(jane_id, home) == 2
+            jane_tasks = lambda shard: [t for t in tasks_in(shard) if t['user_id'] == jane_id]
+            assert len(jane_tasks(home)) == 2 and len(jane_tasks(other)) == 2
+            assert purge_strays() == {other: [jane_id]}
+            assert jane_tasks(other) == [] and len(jane_tasks(home)) == 2
+            assert purge_strays() == {}
+
+            db.session.remove()
+            for shard in (None, 'a', 'b'):
+                engine_for(shard).dispose()
+
+    def test_client_sdk(self):
+        assert parse_datetime('2030-01-15 09:30:00') == datetime(2030, 1, 15, 9, 30)
+        assert parse_datetime('Jan 15 2030') == datetime(2030, 1, 15)
+        # Values with a time zone come back as naive UTC, whichever parser reads them
+        assert parse_datetime('2030-01-15T09:30:00Z') == datetime(2030, 1, 15, 9, 30)
+        assert parse_datetime('2030-01-15T09:30:00+02:00') == datetime(2030, 1, 15, 7, 30)
+        assert parse_datetime('Jan 15 2030 09:30 -0500') == datetime(2030, 1, 15, 14, 30)
+        assert parse_datetime(datetime(2030, 1, 15, 9, 30, tzinfo=timezone.utc)).tzinfo is None
+        with self.assertRaises(ValueError):
+            ClientTask(None)
+        with self.assertRaises(AttributeError):
+            ClientTask('x').colour = 'red'
+        with self.assertRaises(ValueError):
+            ClientTask('x', due_date='not a date')
+
+        u = User(nickname='Jane', password_hash=generate_password_hash('12345'))
+        db.session.add(u)
+        db.session.commit()
+        client = Client(FlaskTransport(self.flask_app), 'Jane', '12345', batch_size=2)
+        client.authenticate()
+        assert client.token
+
+        created = client.create(ClientTask('Write report', due_date='2030-01-15', project='work'))
+        assert created.id and created.due_date == datetime(2030, 1, 15) and created.project == 'work'
+        with client.batch() as batch:
+            batch.create(ClientTask('Book flights', project='travel'))
+            batch.update(created.id, recurrence='FREQ=NEVER')
+            batch.update(created.id, name='Write the report')
+            batch.delete(created.id + 100)
+        assert [type(r) for r in batch.results] == [ClientTask, APIError, ClientTask, APIError]
+        assert batch.results[3].status == 404
+        assert sorted(t.name for t in client.tasks()) == ['Book flights', 'Write the report']
+
+        # Unchanged lists are answered from the local cache after a 304
+        statuses = []
+        request = client.transport.request
+
+        def record(*args):
+            rv = request(*args)
+            statuses.append(rv[0])
+            return rv
+        client.transport.request = record
+        tasks = client.tasks()
+        assert client.tasks() == tasks and statuses[-1] == 304
+        client.update(created.id, complete=True)
+        assert [t.name for t in client.tasks()] == ['Book flights'] and statuses[-1] == 200
+        assert [t.name for t in client.completed()] == ['Write the report']
+        assert [t.name for t in client.search('flig')] == ['Book flights']
+
+        # Lists longer than a page are fetched page by page
+        client.create(ClientTask('Mow lawn'))
+        self.flask_app.config['API_PAGE_SIZE'] = 1
+        del statuses[:]
+        assert sorted(t.name for t in client.tasks()) == ['Book flights', 'Mow lawn'] and len(statuses) >= 2
+
+        assert client.delete(created.id) == created.id
+        with self.assertRaises(APIError):
+            client.update(created.id, name='gone')
+
+    def test_http_transport(self):
+        outcomes, opened = [], []
+
+        class Response(object):
+            def __init__(self, status, will_close):
+                self.status, self.will_close, self.headers = status, will_close, {}
+
+            def read(self):
+                return b'{}'
+
+        class Connection(object):
+            # Stands in for http.client.HTTPConnection; each request takes the next of `outcomes`, which is a
+            # (status, will_close) response or the exception the request or the response raises
+            def __init__(self, host, timeout=None):
+                self.sent, self.closed = [], False
+                opened.append(self)
+
+            def request(self, method, url, body=None, headers=None):
+                self.closed = False
+                self.sent.append(method)
+                self.outcome = outcomes.pop(0)
+                if isinstance(self.outcome, BrokenPipeError):
+                    raise self.outcome
+
+            def getresponse(self):
+                if isinstance(self.outcome, Exception):
+                    raise self.outcome
+                return Response(*self.outcome)
+
+            def close(self):
+                self.closed = True
+
+        transport = HTTPTransport('http://example.com/prefix', pool_size=1)
+        transport.connection_class = Connection
+
+        # Keep-alive connections go back to the pool and are reused
+        outcomes[:] = [(200, False), (200, False)]
+        assert transport.request('GET', '/tasks', {})[0] == 200
+        assert transport.request('GET', '/tasks', {})[0] == 200
+        assert len(opened) == 1 and opened[0].sent == ['GET', 'GET'] and not transport._pool.empty()
+
+        # A reused connection the server has closed is retried once for GETs and for requests it failed to send
+        outcomes[:] = [http.client.RemoteDisconnected(), (200, False), BrokenPipeError(), (201, False)]
+        assert transport.request('GET', '/tasks', {})[0] == 200
+        assert transport.request('POST', '/tasks/create', {}, b'{}')[0] == 201
+        assert len(opened) == 1 and opened[0].sent[2:] == ['GET', 'GET', 'POST', 'POST']
+
+        # but not for a POST that was sent, as the server may have acted on it
+        outcomes[:] = [http.client.RemoteDisconnected()]
+        with self.assertRaises(http.client.RemoteDisconnected):
+            transport.request('POST', '/tasks/create', {}, b'{}')
+        assert opened[0].sent[-2:] == ['POST', 'POST'] and opened[0].closed and transport._pool.empty()
+
+        # New connections are never retried, and those the server will close are not kept
+        outcomes[:] = [ConnectionResetError(), (200, True)]
+        with self.assertRaises(ConnectionResetError):
+            transport.request('GET', '/tasks', {})
+        assert transport.request('GET', '/tasks', {})[0] == 200
+        assert len(opened) == 3 and all(c.closed for c in opened) and transport._pool.empty()
+
+        outcomes[:] = [(200, False)]
+        transport.request('GET', '/tasks', {})
+        transport.close()
+        assert opened[-1].closed and transport._pool.empty()
+
+if __name__ == '__main__':
+    unittest.main()
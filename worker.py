@@ -0,0 +1,22 @@
+import argparse
+import signal
+from app import create_app
+from app.jobs import Worker, work
+
+app = create_app()
+
+parser = argparse.ArgumentParser(description='Run queued background jobs.')
+parser.add_argument('--threads', type=int, default=app.config['JOB_THREADS'])
+parser.add_argument('--burst', action='store_true', help='run the jobs that are due now, then exit')
+args = parser.parse_args()
+
+if args.burst:
+    print('Ran {} jobs'.format(work(app)))
+else:
+    # Block the stop signals before starting the threads so that they are all delivered to sigwait below
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT, signal.SIGTERM})
+    worker = Worker(app, threads=args.threads)
+    worker.start()
+    print('Worker {} running {} threads'.format(worker.name, worker.threads))
+    signal.sigwait({signal.SIGINT, signal.SIGTERM})
+    worker.stop()